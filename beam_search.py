@@ -6,147 +6,398 @@ import numpy as np
 import torch
 import time
 import sys
-from torch.autograd import Variable
+
+from model import expand_beam, sequence_mask
 '''
-fast beam search
+Gather input_ along dim into spare_, which is reused when it has the 
+right size. Returns the gathered tensor and input_ as the next spare.
+Swapping the two buffers every step avoids new allocations.
+'''
+def gather_spare(input_, dim, index, spare_=None):
+    if index.dim() == 1:
+        size_ = input_.size()[:dim] + index.size() + input_.size()[dim+1:]
+    else:
+        size_ = index.size()
+    if spare_ is None or spare_.size() != size_ or spare_ is input_:
+        spare_ = input_.new_empty(size_)
+    if index.dim() == 1:
+        torch.index_select(input_, dim, index, out=spare_)
+    else:
+        torch.gather(input_, dim, index, out=spare_)
+    
+    return spare_, input_
 '''
-def tensor_transformer(seq0, batch_size, beam_size):
-    seq = seq0.unsqueeze(2)
-    seq = seq.repeat(1, 1, beam_size, 1)
-    seq = seq.contiguous().view(batch_size, beam_size*beam_size, seq.size(3))
-    return seq
+Decoder states of all hypotheses.
+Rows are ordered as (batch, beam) and flattened to batch*beam.
+Reordered states are written into double buffers.
+'''
+class BeamState(object):
+
+    def __init__(
+        self,
+        hidden_decoder,
+        h_attn,
+        past_attn,
+        past_dehy,
+        attn_decoder=True
+    ):
+        self.hidden_decoder = hidden_decoder
+        self.h_attn = h_attn
+        self.past_attn = past_attn
+        self.past_dehy = past_dehy
+        self.attn_decoder = attn_decoder
+        self.spare = {}
 
+    def update(self, hidden_decoder, h_attn, past_attn, past_dehy):
+        self.hidden_decoder = hidden_decoder
+        self.h_attn = h_attn
+        self.past_attn = past_attn
+        self.past_dehy = past_dehy
+
+    def reorder(self, index):
+        '''
+        index: rows (batch*beam) of the surviving hypotheses.
+        '''
+        if isinstance(self.hidden_decoder, tuple):
+            h_t, self.spare['h_t'] = gather_spare(
+                self.hidden_decoder[0], 0, index, self.spare.get('h_t'))
+            c_t, self.spare['c_t'] = gather_spare(
+                self.hidden_decoder[1], 0, index, self.spare.get('c_t'))
+            self.hidden_decoder = (h_t, c_t)
+        else:
+            self.hidden_decoder, self.spare['h_t'] = gather_spare(
+                self.hidden_decoder, 0, index, self.spare.get('h_t'))
+        self.h_attn, self.spare['h_attn'] = gather_spare(
+            self.h_attn, 0, index, self.spare.get('h_attn'))
+        self.past_attn, self.spare['past_attn'] = gather_spare(
+            self.past_attn, 0, index, self.spare.get('past_attn'))
+        if self.attn_decoder:
+            self.past_dehy.reorder(index)
+'''
+Attention weights where <unk> can be copied from.
+'''
+def copy_attn(attn_, copy_mask=None):
+    if copy_mask is None:
+        return attn_
+    
+    return attn_*copy_mask
+'''
+Length penalty of Wu et al. (2016), ((5+len)/6)^alpha.
+'''
+def length_penalty(beam_len, alpha):
+    return ((5.0+beam_len.float())/6.0)**alpha
+'''
+Coverage penalty of Wu et al. (2016).
+beta*sum_i log(min(attention paid to source word i, 1.0))
+'''
+def coverage_penalty(beam_cov, beta, src_mask=None):
+    beam_cov = beam_cov.clamp(min=1e-20, max=1.0).log()
+    if src_mask is not None:
+        beam_cov = beam_cov.masked_fill(~src_mask, 0.0)
+    
+    return beta*beam_cov.sum(dim=2)
+'''
+fast beam search
+
+Hypotheses are scored with summed log probabilities.
+A hypothesis is finished once it emits <stop>. It then keeps its score 
+and is padded, and the search stops early when all of them are finished.
+Finished hypotheses are ranked by 
+score/length_penalty + coverage_penalty, best first.
+
+Every step only keeps the words, the beams they extend (backpointers) 
+and the source positions with the largest attention of the hypotheses 
+(attention*copy_mask, e.g. the OOV mask of the source words). 
+Sequences (beam_seq) and copy positions (beam_copy, used to copy <unk>) 
+are traced back from them at the end.
+
+shortlist > 0: words are predicted from the shortlist top words, 
+the source words and the OOV words of the batch only.
+'''
 def fast_beam_search(
-    model, 
+    model,
     src_text,
     src_text_ex,
     vocab2id,
     ext_id2oov,
-    beam_size=4, 
+    beam_size=4,
     max_len=20,
     network='lstm',
     pointer_net=True,
     oov_explicit=True,
-    attn_decoder=True
+    attn_decoder=True,
+    src_lens=None,
+    len_penalty=0.0,
+    cov_penalty=0.0,
+    shortlist=0,
+    copy_mask=None
 ):
     batch_size = src_text.size(0)
     src_seq_len = src_text.size(1)
-    src_text_rep = src_text.unsqueeze(1).clone().repeat(1, beam_size, 1).view(-1, src_text.size(1)).cuda()
+    device = src_text.device
+    src_text_rep = expand_beam(src_text, beam_size)
     if oov_explicit:
-        src_text_rep_ex = src_text_ex.unsqueeze(1).clone().repeat(1, beam_size, 1).view(-1, src_text_ex.size(1)).cuda()
-    if network == 'lstm':
-        encoder_hy, (h0_new, c0_new), h_attn_new, past_attn_new, past_dehy_new = model.forward_encoder(src_text_rep)
-    else:
-        encoder_hy, hidden_decoder_new, h_attn_new, past_attn_new, past_dehy_new = model.forward_encoder(src_text_rep)
-    
-    beam_seq = Variable(torch.LongTensor(batch_size, beam_size, max_len+1).fill_(vocab2id['<pad>'])).cuda()
-    beam_seq[:, :, 0] = vocab2id['<s>']
-    beam_prb = torch.FloatTensor(batch_size, beam_size).fill_(1.0)
-    last_wd = Variable(torch.LongTensor(batch_size, beam_size, 1).fill_(vocab2id['<s>'])).cuda()
-    beam_attn_ = Variable(torch.FloatTensor(max_len, batch_size, beam_size, src_seq_len).fill_(0.0)).cuda()
-    
+        src_text_rep_ex = expand_beam(src_text_ex, beam_size)
+    src_mask = None
+    if src_lens is not None:
+        src_lens = src_lens.to(device)
+        src_mask = expand_beam(sequence_mask(src_lens, src_seq_len), beam_size)
+    encoder_hy, hidden_decoder, h_attn, past_attn, past_dehy, encoder_key = model.forward_encoder_beam(
+        src_text, beam_size, src_lens, max_len)
+    state = BeamState(hidden_decoder, h_attn, past_attn, past_dehy, attn_decoder)
+    vocab_proj = None
+    if shortlist > 0:
+        vocab_idx = torch.cat((
+            torch.arange(min(shortlist, len(vocab2id)), device=device),
+            src_text.view(-1),
+            torch.LongTensor([vocab2id['<stop>'], vocab2id['<unk>']]).to(device))).unique()
+        vocab_proj = model.shortlist_proj(vocab_idx)
+        # words of the shortlist and the OOV words
+        cand_wds = torch.cat((
+            vocab_idx, 
+            torch.arange(len(vocab2id), len(vocab2id)+len(ext_id2oov), device=device)))
+        # the pointer adds attention at the word positions in the shortlist
+        src_text_rep = torch.searchsorted(vocab_idx, src_text_rep)
+        if oov_explicit:
+            src_text_rep_ex = torch.where(
+                src_text_rep_ex < len(vocab2id), 
+                torch.searchsorted(vocab_idx, src_text_rep_ex.clamp(max=len(vocab2id)-1)),
+                src_text_rep_ex - len(vocab2id) + vocab_idx.size(0))
+
+    beam_prb = torch.zeros(batch_size, beam_size, device=device)
+    last_wd = torch.full((batch_size, beam_size, 1), vocab2id['<s>'], dtype=torch.long, device=device)
+    # words, backpointers and copy positions of every step.
+    # finished examples keep <pad> extending the same beams.
+    beam_row = torch.arange(beam_size, device=device)
+    step_wds = torch.full((max_len, batch_size, beam_size), vocab2id['<pad>'], dtype=torch.long, device=device)
+    step_ptr = beam_row.repeat(max_len, batch_size, 1)
+    step_copy = torch.zeros(max_len, batch_size, beam_size, dtype=torch.long, device=device)
+    # length, accumulated attention and <stop> of every hypothesis.
+    # the accumulated attention is only kept for the coverage penalty.
+    track_cov = cov_penalty > 0.0
+    beam_len = torch.zeros(batch_size, beam_size, dtype=torch.long, device=device)
+    beam_end = torch.zeros(batch_size, beam_size, dtype=torch.bool, device=device)
+    if track_cov:
+        beam_cov = torch.zeros(batch_size, beam_size, src_seq_len, device=device)
+    # hypotheses of finished examples.
+    out_prb = beam_prb.clone()
+    out_len = beam_len.clone()
+    if track_cov:
+        out_cov = beam_cov.clone()
+    # examples being decoded. Their rows stay contiguous in all tensors.
+    active = torch.arange(batch_size, device=device)
+    cov_spare = None
+    if copy_mask is not None:
+        copy_mask = copy_mask.to(device).unsqueeze(1)
+
     for j in range(max_len):
+        n_active = active.size(0)
+        # first row of every example in the flattened (n_active*beam) states
+        beam_offset = torch.arange(0, n_active*beam_size, beam_size, device=device).unsqueeze(1)
         if oov_explicit:
             last_wd[last_wd>=len(vocab2id)] = vocab2id['<unk>']
-        if network == 'lstm':
-            logits, (h0, c0), h_attn, past_attn, p_gen, attn_, past_dehy = model.forward_onestep_decoder(
-                j, last_wd.view(-1, 1), (h0_new, c0_new),
-                h_attn_new, encoder_hy, past_attn_new, past_dehy_new)
-        else:
-            logits, hidden_decoder, h_attn, past_attn, p_gen, attn_, past_dehy = model.forward_onestep_decoder(
-                j, last_wd.view(-1, 1), hidden_decoder_new,
-                h_attn_new, encoder_hy, past_attn_new, past_dehy_new)
-        logits = torch.softmax(logits, dim=2)
+        logits, hidden_decoder, h_attn, past_attn, p_gen, attn_, past_dehy = model.forward_onestep_decoder(
+            j, last_wd.view(-1, 1), state.hidden_decoder,
+            state.h_attn, encoder_hy, state.past_attn, state.past_dehy, src_mask, encoder_key, vocab_proj)
+        state.update(hidden_decoder, h_attn, past_attn, past_dehy)
+        logits = torch.softmax(logits.float(), dim=2)
         if pointer_net:
             if oov_explicit and len(ext_id2oov) > 0:
                 logits = model.cal_dist_explicit(src_text_rep_ex, logits, attn_, p_gen, vocab2id, ext_id2oov)
             else:
                 logits = model.cal_dist(src_text_rep, logits, attn_, p_gen, vocab2id)
-           
+
         prob, wds = logits.data.topk(k=beam_size)
-        prob = prob.view(batch_size, beam_size, prob.size(1), prob.size(2))
-        wds = wds.view(batch_size, beam_size, wds.size(1), wds.size(2))
+        if shortlist > 0:
+            wds = cand_wds[wds]
+        prob = torch.log(prob.view(n_active, beam_size, beam_size))
+        wds = wds.view(n_active, beam_size, beam_size)
+        attn_ = attn_.view(n_active, beam_size, attn_.size(-1))
         if j == 0:
-            beam_prb = prob[:, 0, 0]
-            beam_seq[:, :, 1] = wds[:, 0, 0]
-            last_wd = Variable(wds[:, 0, 0].unsqueeze(2).clone()).cuda()
+            beam_prb = prob[:, 0]
+            last_wd = wds[:, 0].unsqueeze(2).clone()
+            step_wds[j] = last_wd.squeeze(2)
+            step_copy[j] = copy_attn(attn_, copy_mask).argmax(dim=2)
+            beam_len += 1
+            if track_cov:
+                beam_cov = beam_cov + attn_
+            beam_end = last_wd.squeeze(2) == vocab2id['<stop>']
+        else:
+            # a finished hypothesis has one candidate, itself with <pad>.
+            prob[:, :, 0].masked_fill_(beam_end, 0.0)
+            prob[:, :, 1:].masked_fill_(beam_end.unsqueeze(2), float('-inf'))
+            wds.masked_fill_(beam_end.unsqueeze(2), vocab2id['<pad>'])
+            # candidate c of an example comes from beam c // beam_size.
+            cand_prob = beam_prb.unsqueeze(2) + prob
+            cand_prob = cand_prob.contiguous().view(n_active, beam_size*beam_size)
+            beam_prb, cand_idx = cand_prob.topk(k=beam_size, dim=1)
+            beam_idx = cand_idx // beam_size
+
+            last_wd = wds.view(n_active, -1).gather(1, cand_idx).unsqueeze(2)
+            attn_ = attn_.gather(
+                1, beam_idx.unsqueeze(2).expand(n_active, beam_size, attn_.size(2)))
+            step_wds[j].index_copy_(0, active, last_wd.squeeze(2))
+            step_ptr[j].index_copy_(0, active, beam_idx)
+            step_copy[j].index_copy_(0, active, copy_attn(attn_, copy_mask).argmax(dim=2))
+            state.reorder((beam_idx + beam_offset).view(-1))
             
-            if network == 'lstm':
-                h0_new = h0
-                c0_new = c0
+            beam_live = ~beam_end.gather(1, beam_idx)
+            beam_len = beam_len.gather(1, beam_idx) + beam_live.long()
+            if track_cov:
+                beam_cov, cov_spare = gather_spare(
+                    beam_cov, 1, beam_idx.unsqueeze(2).expand(n_active, beam_size, src_seq_len), cov_spare)
+                beam_cov.addcmul_(attn_, beam_live.unsqueeze(2).float())
+            beam_end = ~beam_live | (last_wd.squeeze(2) == vocab2id['<stop>'])
+        # drop the examples whose hypotheses have all finished.
+        ex_end = beam_end.all(dim=1)
+        if j == max_len-1:
+            ex_end.fill_(True)
+        if ex_end.any():
+            out_idx = active[ex_end]
+            out_prb.index_copy_(0, out_idx, beam_prb[ex_end])
+            out_len.index_copy_(0, out_idx, beam_len[ex_end])
+            if track_cov:
+                out_cov.index_copy_(0, out_idx, beam_cov[ex_end])
+            if ex_end.all():
+                break
+            keep = (~ex_end).nonzero().squeeze(1)
+            keep_row = (beam_offset[keep] + beam_row.unsqueeze(0)).view(-1)
+            active = active[keep]
+            beam_prb = beam_prb[keep]
+            last_wd = last_wd[keep]
+            beam_len = beam_len[keep]
+            if track_cov:
+                beam_cov = beam_cov[keep]
+            beam_end = beam_end[keep]
+            if copy_mask is not None:
+                copy_mask = copy_mask[keep]
+            state.reorder(keep_row)
+            # encoder_key is encoder_hy if it is not projected.
+            if encoder_key is encoder_hy:
+                encoder_hy = encoder_key = encoder_hy.index_select(0, keep_row)
             else:
-                hidden_decoder_new = hidden_decoder
-            h_attn_new = h_attn
-            attn_new = attn_
-            past_attn_new = past_attn
-            past_dehy_new = past_dehy
-            beam_attn_[j] = attn_new.view(batch_size, beam_size, attn_new.size(-1))
-            continue
-            
-        cand_seq = tensor_transformer(beam_seq, batch_size, beam_size)
-        cand_seq[:, :, j+1] = wds.squeeze(2).view(batch_size, -1)
-        cand_last_wd = wds.squeeze(2).view(batch_size, -1)
+                encoder_hy = encoder_hy.index_select(0, keep_row)
+                encoder_key = encoder_key.index_select(0, keep_row)
+            src_text_rep = src_text_rep.index_select(0, keep_row)
+            if oov_explicit:
+                src_text_rep_ex = src_text_rep_ex.index_select(0, keep_row)
+            if src_mask is not None:
+                src_mask = src_mask.index_select(0, keep_row)
+    # rank the hypotheses
+    beam_prb, beam_len = out_prb, out_len
+    beam_score = beam_prb/length_penalty(beam_len, len_penalty)
+    if track_cov:
+        if src_lens is not None:
+            src_mask = sequence_mask(src_lens, src_seq_len).unsqueeze(1)
+        beam_score = beam_score + coverage_penalty(out_cov, cov_penalty, src_mask)
+    beam_rank = beam_score.sort(dim=1, descending=True, stable=True)[1]
+    beam_prb = beam_prb.gather(1, beam_rank)
+    # trace back the ranked hypotheses
+    beam_seq = torch.full((max_len+1, batch_size, beam_size), vocab2id['<pad>'], dtype=torch.long, device=device)
+    beam_seq[0] = vocab2id['<s>']
+    beam_copy = torch.zeros(max_len, batch_size, beam_size, dtype=torch.long, device=device)
+    beam_idx = beam_rank
+    idx_spare = torch.empty_like(beam_rank)
+    for k in range(j, -1, -1):
+        torch.gather(step_wds[k], 1, beam_idx, out=beam_seq[k+1])
+        torch.gather(step_copy[k], 1, beam_idx, out=beam_copy[k])
+        beam_idx, idx_spare = torch.gather(step_ptr[k], 1, beam_idx, out=idx_spare), beam_idx
+    beam_seq = beam_seq.permute(1, 2, 0)
+    beam_copy = beam_copy.permute(1, 2, 0)
+    
+    return beam_seq, beam_prb, beam_copy
+'''
+fast greedy search
 
-        cand_prob = beam_prb.unsqueeze(1).repeat(1, beam_size, 1).transpose(1,2)
-        cand_prob *= prob[:, :, 0]
-        cand_prob = cand_prob.contiguous().view(batch_size, beam_size*beam_size)
-        if network == 'lstm':
-            h0_new = Variable(torch.zeros(batch_size, beam_size, h0.size(-1))).cuda()
-            c0_new = Variable(torch.zeros(batch_size, beam_size, c0.size(-1))).cuda()
-        else:
-            hidden_decoder_new = Variable(torch.zeros(batch_size, beam_size, hidden_decoder.size(-1))).cuda()
-        h_attn_new = Variable(torch.zeros(batch_size, beam_size, h_attn.size(-1))).cuda()
-        attn_new = Variable(torch.zeros(batch_size, beam_size, attn_.size(-1))).cuda()
-        past_attn_new = Variable(torch.zeros(batch_size, beam_size, past_attn.size(-1))).cuda()
-        if attn_decoder:
-            pdn_size1, pdn_size2 = past_dehy.size(-2), past_dehy.size(-1)
-            past_dehy_new = Variable(torch.zeros(batch_size, beam_size, pdn_size1*pdn_size2)).cuda()
-        if network == 'lstm':
-            h0 = h0.view(batch_size, beam_size, h0.size(-1))
-            h0 = tensor_transformer(h0, batch_size, beam_size)
-            c0 = c0.view(batch_size, beam_size, c0.size(-1))
-            c0 = tensor_transformer(c0, batch_size, beam_size)
-        else:
-            hidden_decoder = hidden_decoder.view(batch_size, beam_size, hidden_decoder.size(-1))
-            hidden_decoder = tensor_transformer(hidden_decoder, batch_size, beam_size)
-        h_attn = h_attn.view(batch_size, beam_size, h_attn.size(-1))
-        h_attn = tensor_transformer(h_attn, batch_size, beam_size)
-        attn_ = attn_.view(batch_size, beam_size, attn_.size(-1))
-        attn_ = tensor_transformer(attn_, batch_size, beam_size)
-        past_attn = past_attn.view(batch_size, beam_size, past_attn.size(-1))
-        past_attn = tensor_transformer(past_attn, batch_size, beam_size)
-        if attn_decoder:
-            past_dehy = past_dehy.contiguous().view(batch_size, beam_size, past_dehy.size(-2)*past_dehy.size(-1))
-            past_dehy = tensor_transformer(past_dehy, batch_size, beam_size)
-        tmp_prb, tmp_idx = cand_prob.topk(k=beam_size, dim=1)
-        for x in range(batch_size):
-            for b in range(beam_size):
-                last_wd[x, b]  = cand_last_wd[x, tmp_idx[x, b]]
-                beam_seq[x, b] = cand_seq[x, tmp_idx[x, b]]
-                beam_prb[x, b] = tmp_prb[x, b]
-                
-                if network == 'lstm':
-                    h0_new[x, b] = h0[x, tmp_idx[x, b]]
-                    c0_new[x, b] = c0[x, tmp_idx[x, b]]
-                else:
-                    hidden_decoder_new[x, b] = hidden_decoder[x, tmp_idx[x, b]]
-                h_attn_new[x, b] = h_attn[x, tmp_idx[x, b]]
-                attn_new[x, b] = attn_[x, tmp_idx[x, b]]
-                past_attn_new[x, b] = past_attn[x, tmp_idx[x, b]]
-                if attn_decoder:
-                    past_dehy_new[x, b] = past_dehy[x, tmp_idx[x, b]]
+Pick the most probable word at every step, or sample it 
+(from the top_k words if top_k > 0). An example stops at <stop> 
+and is dropped from the batch. Outputs have the beam dimension of 
+fast_beam_search, with a single beam.
+'''
+def fast_greedy_search(
+    model,
+    src_text,
+    src_text_ex,
+    vocab2id,
+    ext_id2oov,
+    max_len=20,
+    network='lstm',
+    pointer_net=True,
+    oov_explicit=True,
+    attn_decoder=True,
+    src_lens=None,
+    sample=False,
+    top_k=0,
+    copy_mask=None
+):
+    batch_size = src_text.size(0)
+    src_seq_len = src_text.size(1)
+    device = src_text.device
+    src_mask = None
+    if src_lens is not None:
+        src_lens = src_lens.to(device)
+        src_mask = sequence_mask(src_lens, src_seq_len)
+    encoder_hy, hidden_decoder, h_attn, past_attn, past_dehy = model.forward_encoder(
+        src_text, src_lens, max_len)
+    encoder_key = model.decoder.encoder_attn_layer.precompute(encoder_hy)
+    state = BeamState(hidden_decoder, h_attn, past_attn, past_dehy, attn_decoder)
+    
+    out_seq = torch.full((batch_size, max_len+1), vocab2id['<pad>'], dtype=torch.long, device=device)
+    out_seq[:, 0] = vocab2id['<s>']
+    out_prb = torch.zeros(batch_size, device=device)
+    out_copy = torch.zeros(batch_size, max_len, dtype=torch.long, device=device)
+    last_wd = torch.full((batch_size, 1), vocab2id['<s>'], dtype=torch.long, device=device)
+    # examples being decoded. Their rows stay contiguous in all tensors.
+    active = torch.arange(batch_size, device=device)
+    if copy_mask is not None:
+        copy_mask = copy_mask.to(device)
+    
+    for j in range(max_len):
+        if oov_explicit:
+            last_wd[last_wd>=len(vocab2id)] = vocab2id['<unk>']
+        logits, hidden_decoder, h_attn, past_attn, p_gen, attn_, past_dehy = model.forward_onestep_decoder(
+            j, last_wd, state.hidden_decoder,
+            state.h_attn, encoder_hy, state.past_attn, state.past_dehy, src_mask, encoder_key)
+        state.update(hidden_decoder, h_attn, past_attn, past_dehy)
+        logits = torch.softmax(logits.float(), dim=2)
+        if pointer_net:
+            if oov_explicit and len(ext_id2oov) > 0:
+                logits = model.cal_dist_explicit(src_text_ex, logits, attn_, p_gen, vocab2id, ext_id2oov)
+            else:
+                logits = model.cal_dist(src_text, logits, attn_, p_gen, vocab2id)
+        logits = logits.squeeze(1)
         
-        beam_attn_[j] = attn_new
-        if network == 'lstm':
-            h0_new = h0_new.view(-1, h0_new.size(-1))
-            c0_new = c0_new.view(-1, c0_new.size(-1))
+        if sample and top_k > 0:
+            prob, wds = logits.topk(k=top_k)
+            last_wd = wds.gather(1, torch.multinomial(prob, 1))
+        elif sample:
+            last_wd = torch.multinomial(logits, 1)
         else:
-            hidden_decoder_new = hidden_decoder_new.view(-1, hidden_decoder_new.size(-1))
-        h_attn_new = h_attn_new.view(-1, h_attn_new.size(-1))
-        attn_new = attn_new.view(-1, attn_new.size(-1))
-        past_attn_new = past_attn_new.view(-1, past_attn_new.size(-1))
-        if attn_decoder:
-            past_dehy_new = past_dehy_new.view(-1, pdn_size1, pdn_size2)
-        
-        torch.cuda.empty_cache()
-    return beam_seq, beam_prb, beam_attn_
\ No newline at end of file
+            last_wd = logits.argmax(dim=1, keepdim=True)
+        prob = logits.gather(1, last_wd)
+        out_seq[active, j+1] = last_wd.squeeze(1)
+        out_prb[active] += torch.log(prob.squeeze(1))
+        out_copy[active, j] = copy_attn(attn_, copy_mask).argmax(dim=-1)
+        # drop the finished examples.
+        ex_end = last_wd.squeeze(1) == vocab2id['<stop>']
+        if ex_end.all():
+            break
+        if ex_end.any():
+            keep = (~ex_end).nonzero().squeeze(1)
+            active = active[keep]
+            last_wd = last_wd[keep]
+            if copy_mask is not None:
+                copy_mask = copy_mask[keep]
+            state.reorder(keep)
+            if encoder_key is encoder_hy:
+                encoder_hy = encoder_key = encoder_hy.index_select(0, keep)
+            else:
+                encoder_hy = encoder_hy.index_select(0, keep)
+                encoder_key = encoder_key.index_select(0, keep)
+            src_text = src_text.index_select(0, keep)
+            if oov_explicit:
+                src_text_ex = src_text_ex.index_select(0, keep)
+            if src_mask is not None:
+                src_mask = src_mask.index_select(0, keep)
+    
+    return out_seq.unsqueeze(1), out_prb.unsqueeze(1), out_copy.unsqueeze(1)
@@ -6,6 +6,7 @@ import os
 import re
 import glob
 import shutil
+import multiprocessing
 import random
 import numpy as np
 
@@ -36,62 +37,143 @@ def construct_vocab(file_, max_size=200000, mincount=5):
     
     return vocab2id, id2vocab
 '''
-Split the corpus into batches.
+Byte offsets of the lines in a corpus file.
 '''
-def create_batch_file(path_, fkey_, file_, batch_size):
-    file_name = os.path.join(path_, file_)
-    folder = os.path.join(path_, 'batch_'+fkey_+'_'+str(batch_size))
+def index_corpus(file_name):
+    offsets = []
+    start = 0
+    with open(file_name, 'rb') as fp:
+        for line in fp:
+            offsets.append(start)
+            start += len(line)
     
-    try:
-        shutil.rmtree(folder)
-        os.mkdir(folder)
-    except:
-        os.mkdir(folder)
+    return np.array(offsets, dtype=np.int64)
+'''
+The corpus stays in place. Documents are read by line offsets.
+'''
+class TextCorpus(object):
     
-    corpus_arr = []
-    fp = open(file_name, 'r')
-    for line in fp:
-        corpus_arr.append(line.lower())
-    fp.close()
-    if fkey_ == 'train' or fkey_== 'validate':
-        random.shuffle(corpus_arr)
+    def __init__(self, path_, file_):
+        self.file_name = os.path.join(path_, file_)
+        self.offsets = index_corpus(self.file_name)
+        self.lengths_ = None
         
-    cnt = 0
-    for itm in corpus_arr:
-        try:
-            arr.append(itm)
-        except:
-            arr = [itm]
-        if len(arr) == batch_size:
-            fout = open(os.path.join(folder, str(cnt)), 'w')
-            for sen in arr:
-                fout.write(sen)
-            fout.close()
+    def __len__(self):
+        return self.offsets.shape[0]
+    
+    def lines(self, doc_ids):
+        '''
+        lowercased documents without the line break.
+        '''
+        output_ = []
+        with open(self.file_name, 'rb') as fp:
+            for doc_id in doc_ids:
+                fp.seek(self.offsets[doc_id])
+                line = fp.readline().decode('utf-8')
+                output_.append(line.rstrip('\n').lower())
+        
+        return output_
+    
+    def lengths(self):
+        '''
+        number of summary and article words of each document.
+        '''
+        if self.lengths_ is None:
+            lens = []
+            with open(self.file_name, 'rb') as fp:
+                for line in fp:
+                    arr = re.split('<sec>', line.decode('utf-8'))
+                    lens.append([len(arr[0].split()), len(arr[1].split())])
+            self.lengths_ = np.array(lens, dtype=np.int64).reshape(-1, 2)
+        
+        return self.lengths_
+'''
+Split the documents into batches.
+Each epoch draws a new permutation from (seed, epoch).
+'''
+class BatchSampler(object):
+    
+    def __init__(self, n_doc, batch_size, shuffle=True, seed=0):
+        self.n_doc = n_doc
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        
+    def batches(self, epoch=0):
+        if self.shuffle:
+            doc_ids = np.random.RandomState(self.seed+epoch).permutation(self.n_doc)
+        else:
+            doc_ids = np.arange(self.n_doc)
+        
+        return [
+            doc_ids[k:k+self.batch_size].tolist() 
+            for k in range(0, self.n_doc, self.batch_size)
+        ]
+'''
+Group documents of similar length into batches.
+The padded source and target tokens of a batch fit in max_tokens.
+lengths: number of summary and article words of each document.
+'''
+class BucketBatchSampler(BatchSampler):
+    
+    def __init__(self, lengths, max_tokens, max_lens=[400, 100], shuffle=True, seed=0, pool_size=1000):
+        self.n_doc = lengths.shape[0]
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.pool_size = pool_size
+        self.src_lens = np.minimum(lengths[:, 1], max_lens[0])
+        self.trg_lens = np.minimum(lengths[:, 0]+1, max_lens[1])
+        
+    def batches(self, epoch=0):
+        rng = np.random.RandomState(self.seed+epoch)
+        if self.shuffle:
+            doc_ids = rng.permutation(self.n_doc)
+        else:
+            doc_ids = np.arange(self.n_doc)
+        
+        output_ = []
+        for k in range(0, self.n_doc, self.pool_size):
+            pool = doc_ids[k:k+self.pool_size]
+            pool = pool[np.lexsort((self.trg_lens[pool], self.src_lens[pool]))]
             arr = []
-            cnt += 1
+            src_max_lens = trg_max_lens = 0
+            for doc_id in pool.tolist():
+                src_lens = max(src_max_lens, self.src_lens[doc_id])
+                trg_lens = max(trg_max_lens, self.trg_lens[doc_id])
+                if len(arr) > 0 and (len(arr)+1)*(src_lens+trg_lens) > self.max_tokens:
+                    output_.append(arr)
+                    arr = []
+                    src_lens = self.src_lens[doc_id]
+                    trg_lens = self.trg_lens[doc_id]
+                arr.append(doc_id)
+                src_max_lens, trg_max_lens = src_lens, trg_lens
+            if len(arr) > 0:
+                output_.append(arr)
+        if self.shuffle:
+            rng.shuffle(output_)
         
-    if len(arr) > 0:
-        fout = open(os.path.join(folder, str(cnt)), 'w')
-        for sen in arr:
-            fout.write(sen)
-        fout.close()
-        arr = []
-        cnt += 1
+        return output_
+'''
+Pad to the longest document in the batch instead of max_lens.
+trg_lens includes <stop>, and the decoder input / output is one shorter.
+'''
+def longest_lens(src_lens, trg_lens, max_lens):
+    src_max_lens = min(max(src_lens), max_lens[0])
+    trg_max_lens = min(max(trg_lens), max_lens[1]) - 1
     
-    return cnt
+    return max(src_max_lens, 1), max(trg_max_lens, 1)
 '''
 Process the minibatch.
 '''
-def process_minibatch(batch_id, path_, fkey_, batch_size, src_vocab2id, vocab2id, max_lens=[400, 100]):
+def process_minibatch(lines, src_vocab2id, vocab2id, max_lens=[400, 100], pad_to_longest=False):
     
-    file_ = os.path.join(path_, 'batch_'+fkey_+'_'+str(batch_size), str(batch_id))
-    fp = open(file_, 'r')
     src_arr = []
     trg_arr = []
     src_lens = []
     trg_lens = []
-    for line in fp:
-        arr = re.split('<sec>', line[:-1])
+    for line in lines:
+        arr = re.split('<sec>', line)
         dabs = re.split('\s', arr[0])
         dabs = list(filter(None, dabs)) + ['<stop>']
         trg_lens.append(len(dabs))
@@ -112,13 +194,15 @@ def process_minibatch(batch_id, path_, fkey_, batch_size, src_vocab2id, vocab2id
             for wd in dart
         ]
         src_arr.append(dart2id)
-    fp.close()
     
     src_max_lens = max_lens[0]
     trg_max_lens = max_lens[1]
             
     src_arr = [itm[:src_max_lens] for itm in src_arr]
     trg_arr = [itm[:trg_max_lens] for itm in trg_arr]
+    src_lens = [len(itm) for itm in src_arr]
+    if pad_to_longest:
+        src_max_lens, trg_max_lens = longest_lens(src_lens, trg_lens, max_lens)
 
     src_arr = [
         itm + [src_vocab2id['<pad>']]*(src_max_lens-len(itm))
@@ -136,84 +220,70 @@ def process_minibatch(batch_id, path_, fkey_, batch_size, src_vocab2id, vocab2id
     src_var = Variable(torch.LongTensor(src_arr))
     trg_input_var = Variable(torch.LongTensor(trg_input_arr))
     trg_output_var = Variable(torch.LongTensor(trg_output_arr))
+    src_lens_var = torch.LongTensor(src_lens)
     
-    return src_var, trg_input_var, trg_output_var
+    return src_var, trg_input_var, trg_output_var, src_lens_var
+'''
+Map words to ids in one pass.
+OOV words get extended ids, len(vocab2id) onwards, in the order they 
+first appear. ext_vocab and ext_id2oov are filled in place, so they can 
+be shared by all documents of a minibatch.
+'''
+def encode_oov(words, vocab2id, ext_vocab, ext_id2oov):
+    '''
+    return ids with <unk>, extended ids, OOV mask (1.0 for OOV words).
+    '''
+    unk_id = vocab2id['<unk>']
+    wd2id = []
+    wd2id_ex = []
+    wd2oov = []
+    for wd in words:
+        idx = vocab2id.get(wd)
+        if idx is not None:
+            wd2id.append(idx)
+            wd2id_ex.append(idx)
+            wd2oov.append(0.0)
+            continue
+        idx = ext_vocab.get(wd)
+        if idx is None:
+            idx = len(vocab2id) + len(ext_vocab)
+            ext_vocab[wd] = idx
+            ext_id2oov[idx] = wd
+        wd2id.append(unk_id)
+        wd2id_ex.append(idx)
+        wd2oov.append(1.0)
+    
+    return wd2id, wd2id_ex, wd2oov
 '''
 Process the minibatch. 
 OOV explicit.
 '''
-def process_minibatch_explicit(batch_id, path_, fkey_, batch_size, vocab2id, max_lens=[400, 100]):
+def process_minibatch_explicit(lines, vocab2id, max_lens=[400, 100], pad_to_longest=False):
     
-    file_ = os.path.join(path_, 'batch_'+fkey_+'_'+str(batch_size), str(batch_id))
-    # build extended vocabulary
-    fp = open(file_, 'r')
     ext_vocab = {}
     ext_id2oov = {}
-    for line in fp:
-        arr = re.split('<sec>', line[:-1])
-        dabs = re.split('\s', arr[0])
-        dabs = list(filter(None, dabs))
-        for wd in dabs:
-            if wd not in vocab2id:
-                ext_vocab[wd] = {}
-        dart = re.split('\s', arr[1])
-        dart = list(filter(None, dart))
-        for wd in dart:
-            if wd not in vocab2id:
-                ext_vocab[wd] = {}
-    cnt = len(vocab2id)
-    for wd in ext_vocab:
-        ext_vocab[wd] = cnt
-        ext_id2oov[cnt] = wd
-        cnt += 1
-    fp.close()
-    
-    fp = open(file_, 'r')
     src_arr = []
     src_arr_ex = []
     trg_arr = []
     trg_arr_ex = []
     src_lens = []
     trg_lens = []
-    for line in fp:
+    for line in lines:
         # abstract
-        arr = re.split('<sec>', line[:-1])
+        arr = re.split('<sec>', line)
         dabs = re.split('\s', arr[0])
         dabs = list(filter(None, dabs)) + ['<stop>']
         trg_lens.append(len(dabs))
-        # UNK
-        dabs2id = [
-            vocab2id[wd] if wd in vocab2id
-            else vocab2id['<unk>']
-            for wd in dabs
-        ]
+        dabs2id, dabs2id_ex, _ = encode_oov(dabs, vocab2id, ext_vocab, ext_id2oov)
         trg_arr.append(dabs2id)
-        # extend vocab
-        dabs2id = [
-            vocab2id[wd] if wd in vocab2id
-            else ext_vocab[wd]
-            for wd in dabs
-        ]
-        trg_arr_ex.append(dabs2id)
+        trg_arr_ex.append(dabs2id_ex)
         # article
         dart = re.split('\s', arr[1])
         dart = list(filter(None, dart))
         src_lens.append(len(dart))
-        # UNK
-        dart2id = [
-            vocab2id[wd] if wd in vocab2id
-            else vocab2id['<unk>']
-            for wd in dart
-        ]
+        dart2id, dart2id_ex, _ = encode_oov(dart, vocab2id, ext_vocab, ext_id2oov)
         src_arr.append(dart2id)
-        # extend vocab
-        dart2id = [
-            vocab2id[wd] if wd in vocab2id
-            else ext_vocab[wd]
-            for wd in dart
-        ]
-        src_arr_ex.append(dart2id)
-    fp.close()
+        src_arr_ex.append(dart2id_ex)
     
     src_max_lens = max_lens[0]
     trg_max_lens = max_lens[1]
@@ -222,6 +292,9 @@ def process_minibatch_explicit(batch_id, path_, fkey_, batch_size, vocab2id, max
     trg_arr = [itm[:trg_max_lens] for itm in trg_arr]
     src_arr_ex = [itm[:src_max_lens] for itm in src_arr_ex]
     trg_arr_ex = [itm[:trg_max_lens] for itm in trg_arr_ex]
+    src_lens = [len(itm) for itm in src_arr]
+    if pad_to_longest:
+        src_max_lens, trg_max_lens = longest_lens(src_lens, trg_lens, max_lens)
 
     src_arr = [
         itm + [vocab2id['<pad>']]*(src_max_lens-len(itm))
@@ -246,22 +319,21 @@ def process_minibatch_explicit(batch_id, path_, fkey_, batch_size, vocab2id, max
     # extend oov
     src_var_ex = Variable(torch.LongTensor(src_arr_ex))
     trg_output_var_ex = Variable(torch.LongTensor(trg_output_arr_ex))
+    src_lens_var = torch.LongTensor(src_lens)
     
     return ext_id2oov, src_var, trg_input_var, \
-           src_var_ex, trg_output_var_ex
+           src_var_ex, trg_output_var_ex, src_lens_var
 '''
 Process the minibatch test
 '''
-def process_minibatch_test(batch_id, path_, batch_size, vocab2id, src_lens):
+def process_minibatch_test(lines, vocab2id, src_lens):
     
-    file_ = os.path.join(path_, 'batch_test_'+str(batch_size), str(batch_id))
-    fp = open(file_, 'r')
     src_arr = []
     src_idx = []
     src_wt = []
     trg_arr = []
-    for line in fp:
-        arr = re.split('<sec>', line[:-1])
+    for line in lines:
+        arr = re.split('<sec>', line)
         dabs = re.split('\s', arr[0])
         dabs = list(filter(None, dabs))
         dabs = ' '.join(dabs)
@@ -270,13 +342,12 @@ def process_minibatch_test(batch_id, path_, batch_size, vocab2id, src_lens):
         dart = re.split('\s', arr[1])
         dart = list(filter(None, dart))
         src_arr.append(dart)
-        dart2id = [vocab2id[wd] if wd in vocab2id else vocab2id['<unk>'] for wd in dart]
+        dart2id, _, dart2wt = encode_oov(dart, vocab2id, {}, {})
         src_idx.append(dart2id)
-        dart2wt = [0.0 if wd in vocab2id else 1.0 for wd in dart]
         src_wt.append(dart2wt)
-    fp.close()
 
     src_idx = [itm[:src_lens] for itm in src_idx]
+    src_lens_var = torch.LongTensor([len(itm) for itm in src_idx])
     src_idx = [itm + [vocab2id['<pad>']]*(src_lens-len(itm)) for itm in src_idx]
     src_var = Variable(torch.LongTensor(src_idx))
     
@@ -287,40 +358,22 @@ def process_minibatch_test(batch_id, path_, batch_size, vocab2id, src_lens):
     src_arr = [itm[:src_lens] for itm in src_arr]
     src_arr = [itm + ['<pad>']*(src_lens-len(itm)) for itm in src_arr]
 
-    return src_var, src_arr, src_msk, trg_arr
+    return src_var, src_arr, src_msk, trg_arr, src_lens_var
 '''
 Process the minibatch test. 
 OOV explicit.
 '''
-def process_minibatch_explicit_test(batch_id, path_, batch_size, vocab2id, src_lens):
+def process_minibatch_explicit_test(lines, vocab2id, src_lens):
     
-    file_ = os.path.join(path_, 'batch_test_'+str(batch_size), str(batch_id))
-    # build extended vocabulary
-    fp = open(file_, 'r')
     ext_vocab = {}
     ext_id2oov = {}
-    for line in fp:
-        arr = re.split('<sec>', line[:-1])
-        dart = re.split('\s', arr[1])
-        dart = list(filter(None, dart))
-        for wd in dart:
-            if wd not in vocab2id:
-                ext_vocab[wd] = {}
-    cnt = len(vocab2id)
-    for wd in ext_vocab:
-        ext_vocab[wd] = cnt
-        ext_id2oov[cnt] = wd
-        cnt += 1
-    fp.close()
-    
-    fp = open(file_, 'r')
     src_arr = []
     src_idx = []
     src_idx_ex = []
     src_wt = []
     trg_arr = []
-    for line in fp:
-        arr = re.split('<sec>', line[:-1])
+    for line in lines:
+        arr = re.split('<sec>', line)
         dabs = re.split('\s', arr[0])
         dabs = list(filter(None, dabs))
         dabs = ' '.join(dabs)
@@ -329,15 +382,13 @@ def process_minibatch_explicit_test(batch_id, path_, batch_size, vocab2id, src_l
         dart = re.split('\s', arr[1])
         dart = list(filter(None, dart))
         src_arr.append(dart)
-        dart2id = [vocab2id[wd] if wd in vocab2id else vocab2id['<unk>'] for wd in dart]
+        dart2id, dart2id_ex, dart2wt = encode_oov(dart, vocab2id, ext_vocab, ext_id2oov)
         src_idx.append(dart2id)
-        dart2id = [vocab2id[wd] if wd in vocab2id else ext_vocab[wd] for wd in dart]
-        src_idx_ex.append(dart2id)
-        dart2wt = [0.0 if wd in vocab2id else 1.0 for wd in dart]
+        src_idx_ex.append(dart2id_ex)
         src_wt.append(dart2wt)
-    fp.close()
 
     src_idx = [itm[:src_lens] for itm in src_idx]
+    src_lens_var = torch.LongTensor([len(itm) for itm in src_idx])
     src_idx = [itm + [vocab2id['<pad>']]*(src_lens-len(itm)) for itm in src_idx]
     src_var = Variable(torch.LongTensor(src_idx))
     
@@ -352,4 +403,270 @@ def process_minibatch_explicit_test(batch_id, path_, batch_size, vocab2id, src_l
     src_arr = [itm[:src_lens] for itm in src_arr]
     src_arr = [itm + ['<pad>']*(src_lens-len(itm)) for itm in src_arr]
     
-    return ext_id2oov, src_var, src_var_ex, src_arr, src_msk, trg_arr
+    return ext_id2oov, src_var, src_var_ex, src_arr, src_msk, trg_arr, src_lens_var
+'''
+Compile the corpus into a flat int32 token array.
+Each document is stored as summary tokens followed by article tokens.
+index.npy: [start, summary length, article length] of each document.
+words.txt: word of each token id.
+'''
+def compile_corpus(path_, fkey_, file_):
+    file_name = os.path.join(path_, file_)
+    folder = os.path.join(path_, 'compiled_'+fkey_)
+    
+    try:
+        shutil.rmtree(folder)
+        os.mkdir(folder)
+    except:
+        os.mkdir(folder)
+    
+    word2id = {}
+    index = []
+    start = 0
+    fout = open(os.path.join(folder, 'tokens.bin'), 'wb')
+    fp = open(file_name, 'r')
+    for line in fp:
+        arr = re.split('<sec>', line.rstrip('\n').lower())
+        dabs = arr[0].split()
+        dart = arr[1].split()
+        doc2id = [word2id.setdefault(wd, len(word2id)) for wd in dabs + dart]
+        np.array(doc2id, dtype=np.int32).tofile(fout)
+        index.append([start, len(dabs), len(dart)])
+        start += len(doc2id)
+    fp.close()
+    fout.close()
+    
+    index = np.array(index, dtype=np.int64).reshape(-1, 3)
+    np.save(os.path.join(folder, 'index.npy'), index)
+    fout = open(os.path.join(folder, 'words.txt'), 'w')
+    for wd in word2id:
+        fout.write(wd+'\n')
+    fout.close()
+    # written last, so an interrupted compile is redone.
+    fout = open(os.path.join(folder, 'source.txt'), 'w')
+    fout.write(corpus_source(file_name)+'\n')
+    fout.close()
+    
+    return index.shape[0]
+'''
+Path, size and modification time of the text file of a compiled corpus.
+'''
+def corpus_source(file_name):
+    stat_ = os.stat(file_name)
+    
+    return '\t'.join([
+        os.path.abspath(file_name), str(stat_.st_size), str(stat_.st_mtime_ns)])
+'''
+Memory-mapped corpus created by compile_corpus.
+'''
+class CompiledCorpus(object):
+    
+    def __init__(self, path_, fkey_, vocab2id, src_vocab2id=None):
+        self.folder = os.path.join(path_, 'compiled_'+fkey_)
+        self.index = np.load(os.path.join(self.folder, 'index.npy'))
+        fp = open(os.path.join(self.folder, 'words.txt'), 'r')
+        self.id2word = [wd[:-1] for wd in fp]
+        fp.close()
+        # corpus word id --> vocabulary id, -1 for OOV
+        self.word2vocab = np.array([
+            vocab2id[wd] if wd in vocab2id else -1
+            for wd in self.id2word], dtype=np.int64)
+        if src_vocab2id is None or src_vocab2id is vocab2id:
+            self.word2src = self.word2vocab
+        else:
+            self.word2src = np.array([
+                src_vocab2id[wd] if wd in src_vocab2id else -1
+                for wd in self.id2word], dtype=np.int64)
+        self.tokens_ = None
+        
+    def __len__(self):
+        return self.index.shape[0]
+    
+    def lengths(self):
+        '''
+        number of summary and article words of each document.
+        '''
+        return self.index[:, 1:]
+    
+    def __getstate__(self):
+        # memmap is opened again in each process.
+        state = self.__dict__.copy()
+        state['tokens_'] = None
+        return state
+    
+    def document(self, doc_id):
+        '''
+        corpus word ids of the summary and the article.
+        '''
+        if self.tokens_ is None:
+            self.tokens_ = np.memmap(
+                os.path.join(self.folder, 'tokens.bin'), dtype=np.int32, mode='r')
+        start, trg_len, src_len = self.index[doc_id]
+        dabs = np.array(self.tokens_[start:start+trg_len], dtype=np.int64)
+        dart = np.array(self.tokens_[start+trg_len:start+trg_len+src_len], dtype=np.int64)
+        
+        return dabs, dart
+'''
+Compile the corpus if it does not exist or is older than the text file.
+'''
+def load_compiled_corpus(path_, fkey_, file_, vocab2id, src_vocab2id=None):
+    file_name = os.path.join(path_, file_)
+    file_source = os.path.join(path_, 'compiled_'+fkey_, 'source.txt')
+    # compile again if the text file is another one or has changed.
+    source_ = None
+    if os.path.exists(file_source):
+        fp = open(file_source, 'r')
+        source_ = fp.read().rstrip('\n')
+        fp.close()
+    if source_ != corpus_source(file_name):
+        compile_corpus(path_, fkey_, file_)
+    
+    return CompiledCorpus(path_, fkey_, vocab2id, src_vocab2id)
+'''
+Pad the summary (with <stop>) to the decoder input and output.
+'''
+def compiled_target(dabs2id, vocab2id, trg_max_lens, trg_pad_lens):
+    itm = np.append(dabs2id, vocab2id['<stop>'])[:trg_max_lens]
+    trg_input = np.full(trg_pad_lens, vocab2id['<pad>'], dtype=np.int64)
+    trg_output = np.full(trg_pad_lens, vocab2id['<pad>'], dtype=np.int64)
+    trg_input[:len(itm)-1] = itm[:-1]
+    trg_output[:len(itm)-1] = itm[1:]
+    
+    return trg_input, trg_output
+'''
+Process the minibatch from the compiled corpus.
+'''
+def process_minibatch_compiled(corpus, doc_ids, src_vocab2id, vocab2id, max_lens=[400, 100], pad_to_longest=False):
+    
+    src_max_lens = max_lens[0]
+    trg_max_lens = max_lens[1]
+    src_pad_lens, trg_pad_lens = max_lens
+    if pad_to_longest:
+        src_pad_lens, trg_pad_lens = longest_lens(
+            corpus.index[doc_ids, 2], corpus.index[doc_ids, 1]+1, max_lens)
+    
+    src_arr = np.full((len(doc_ids), src_pad_lens), src_vocab2id['<pad>'], dtype=np.int64)
+    trg_input_arr = np.full((len(doc_ids), trg_pad_lens), vocab2id['<pad>'], dtype=np.int64)
+    trg_output_arr = np.full((len(doc_ids), trg_pad_lens), vocab2id['<pad>'], dtype=np.int64)
+    for k, doc_id in enumerate(doc_ids):
+        dabs, dart = corpus.document(doc_id)
+        # UNK
+        dabs2id = corpus.word2vocab[dabs]
+        dabs2id[dabs2id < 0] = vocab2id['<unk>']
+        trg_input_arr[k], trg_output_arr[k] = compiled_target(
+            dabs2id, vocab2id, trg_max_lens, trg_pad_lens)
+        
+        dart2id = corpus.word2src[dart[:src_max_lens]]
+        dart2id[dart2id < 0] = src_vocab2id['<unk>']
+        src_arr[k, :len(dart2id)] = dart2id
+    
+    src_var = torch.from_numpy(src_arr)
+    trg_input_var = torch.from_numpy(trg_input_arr)
+    trg_output_var = torch.from_numpy(trg_output_arr)
+    src_lens_var = torch.from_numpy(
+        np.minimum(corpus.index[doc_ids, 2], src_max_lens))
+    
+    return src_var, trg_input_var, trg_output_var, src_lens_var
+'''
+Process the minibatch from the compiled corpus. 
+OOV explicit.
+'''
+def process_minibatch_compiled_explicit(corpus, doc_ids, vocab2id, max_lens=[400, 100], pad_to_longest=False):
+    
+    src_max_lens = max_lens[0]
+    trg_max_lens = max_lens[1]
+    src_pad_lens, trg_pad_lens = max_lens
+    if pad_to_longest:
+        src_pad_lens, trg_pad_lens = longest_lens(
+            corpus.index[doc_ids, 2], corpus.index[doc_ids, 1]+1, max_lens)
+    
+    docs = [corpus.document(doc_id) for doc_id in doc_ids]
+    # build extended vocabulary, in the order the words first appear.
+    batch_words = np.concatenate([np.concatenate(doc) for doc in docs])
+    batch_oov = batch_words[corpus.word2vocab[batch_words] < 0]
+    oov_words, oov_first = np.unique(batch_oov, return_index=True)
+    ext_vocab = {}
+    ext_id2oov = {}
+    encode_oov(
+        [corpus.id2word[wd] for wd in batch_oov[np.sort(oov_first)]], 
+        vocab2id, ext_vocab, ext_id2oov)
+    oov2ext = np.array([ext_vocab[corpus.id2word[wd]] for wd in oov_words], dtype=np.int64)
+    
+    src_arr = np.full((len(doc_ids), src_pad_lens), vocab2id['<pad>'], dtype=np.int64)
+    src_arr_ex = np.full((len(doc_ids), src_pad_lens), vocab2id['<pad>'], dtype=np.int64)
+    trg_input_arr = np.full((len(doc_ids), trg_pad_lens), vocab2id['<pad>'], dtype=np.int64)
+    trg_output_arr_ex = np.full((len(doc_ids), trg_pad_lens), vocab2id['<pad>'], dtype=np.int64)
+    for k, (dabs, dart) in enumerate(docs):
+        dart = dart[:src_max_lens]
+        dabs2id = corpus.word2vocab[dabs]
+        dart2id = corpus.word2vocab[dart]
+        # extend vocab
+        dabs2id_ex = dabs2id.copy()
+        dabs2id_ex[dabs2id < 0] = oov2ext[
+            np.searchsorted(oov_words, dabs[dabs2id < 0])]
+        dart2id_ex = dart2id.copy()
+        dart2id_ex[dart2id < 0] = oov2ext[
+            np.searchsorted(oov_words, dart[dart2id < 0])]
+        # UNK
+        dabs2id[dabs2id < 0] = vocab2id['<unk>']
+        dart2id[dart2id < 0] = vocab2id['<unk>']
+        
+        trg_input_arr[k] = compiled_target(
+            dabs2id, vocab2id, trg_max_lens, trg_pad_lens)[0]
+        trg_output_arr_ex[k] = compiled_target(
+            dabs2id_ex, vocab2id, trg_max_lens, trg_pad_lens)[1]
+        src_arr[k, :len(dart2id)] = dart2id
+        src_arr_ex[k, :len(dart2id_ex)] = dart2id_ex
+        
+    src_var = torch.from_numpy(src_arr)
+    trg_input_var = torch.from_numpy(trg_input_arr)
+    # extend oov
+    src_var_ex = torch.from_numpy(src_arr_ex)
+    trg_output_var_ex = torch.from_numpy(trg_output_arr_ex)
+    src_lens_var = torch.from_numpy(
+        np.minimum(corpus.index[doc_ids, 2], src_max_lens))
+    
+    return ext_id2oov, src_var, trg_input_var, \
+           src_var_ex, trg_output_var_ex, src_lens_var
+'''
+Minibatches of a corpus. Item k is batch_docs[k] processed by build_fn.
+build_fn is one of the process_minibatch functions and kwargs are its
+other arguments. Documents come from a CompiledCorpus or a TextCorpus.
+'''
+class MinibatchDataset(torch.utils.data.Dataset):
+    
+    def __init__(self, corpus, batch_docs, build_fn, **kwargs):
+        self.corpus = corpus
+        self.batch_docs = batch_docs
+        self.build_fn = build_fn
+        self.kwargs = kwargs
+        
+    def __len__(self):
+        return len(self.batch_docs)
+    
+    def __getitem__(self, batch_id):
+        doc_ids = self.batch_docs[batch_id]
+        if isinstance(self.corpus, CompiledCorpus):
+            return self.build_fn(corpus=self.corpus, doc_ids=doc_ids, **self.kwargs)
+        
+        return self.build_fn(lines=self.corpus.lines(doc_ids), **self.kwargs)
+'''
+Build minibatches in background worker processes, in order.
+Every worker keeps prefetch batches ahead of the training step.
+num_workers=0 builds them in the main process.
+Workers are forked, since main.py runs its tasks at import time and 
+spawned workers would run them again. Without fork (Windows), 
+minibatches are built in the main process.
+'''
+def minibatch_loader(dataset, num_workers=0, prefetch=2, pin_memory=False):
+    if num_workers > 0 and 'fork' not in multiprocessing.get_all_start_methods():
+        print('Workers need the fork start method. Build minibatches in the main process.')
+        num_workers = 0
+    if num_workers == 0:
+        return torch.utils.data.DataLoader(
+            dataset, batch_size=None, shuffle=False, pin_memory=pin_memory)
+    
+    return torch.utils.data.DataLoader(
+        dataset, batch_size=None, shuffle=False, 
+        num_workers=num_workers, prefetch_factor=prefetch, 
+        pin_memory=pin_memory, multiprocessing_context='fork')
@@ -8,6 +8,7 @@ import argparse
 import shutil
 import glob
 import time
+import functools
 
 import torch
 from torch.autograd import Variable
@@ -19,11 +20,16 @@ from beam_search import *
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--task', default='train', help='train | validate | rouge | beam')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', help='cuda | cpu')
 parser.add_argument('--data_dir', default='../sum_data/', help='directory that store the data.')
 parser.add_argument('--file_vocab', default='vocab', help='file store training vocabulary.')
 parser.add_argument('--file_corpus', default='train.txt', help='file store training documents.')
 parser.add_argument('--n_epoch', type=int, default=35, help='number of epochs.')
 parser.add_argument('--batch_size', type=int, default=16, help='batch size.')
+parser.add_argument('--num_workers', type=int, default=0, help='processes that build training batches in the background. 0: build in the main process.')
+parser.add_argument('--prefetch', type=int, default=2, help='batches each worker builds ahead.')
+parser.add_argument('--pin_memory', type=str2bool, default=False, help='build batches in pinned memory?')
+parser.add_argument('--batch_tokens', type=int, default=0, help='token budget of length-bucketed batches. 0: use batch_size.')
 parser.add_argument('--src_seq_lens', type=int, default=400, help='length of source documents.')
 parser.add_argument('--trg_seq_lens', type=int, default=100, help='length of trage documents.')
 parser.add_argument('--src_emb_dim', type=int, default=128, help='source embedding dimension')
@@ -50,16 +56,25 @@ parser.add_argument('--share_emb_weight', type=str2bool, default=True, help='sha
 
 parser.add_argument('--learning_rate', type=float, default=0.0001, help='learning rate.')
 parser.add_argument('--grad_clip', type=float, default=2.0, help='clip the gradient norm.')
+parser.add_argument('--logits_budget_mb', type=int, default=0, help='memory (MB) of the vocabulary logits. The loss is computed over chunks of target steps that fit in it. 0: all steps at once.')
+parser.add_argument('--amp', type=str2bool, default=False, help='mixed precision? bfloat16 on cpu, float16 with loss scaling on cuda.')
 parser.add_argument('--checkpoint', type=int, default=100, help='How often you want to save model?')
 parser.add_argument('--nbestmodel', type=int, default=50, help='How many models you want to keep?')
 parser.add_argument('--val_num_batch', type=int, default=10, help='how many batches')
 parser.add_argument('--use_move_avg', type=str2bool, default=True, help='move average')
 parser.add_argument('--continue_training', type=str2bool, default=True, help='Do you want to continue?')
 parser.add_argument('--debug', type=str2bool, default=False, help='if true will clean the output after training')
+parser.add_argument('--compiled_corpus', type=str2bool, default=False, help='load train / validate batches from the compiled corpus?')
+parser.add_argument('--seed', type=int, default=0, help='seed of the batch shuffling.')
 parser.add_argument('--file_val', default='val.txt', help='val data')
 # beam search
 parser.add_argument('--file_test', default='test.txt', help='test data')
+parser.add_argument('--decode', default='beam', choices=['beam', 'greedy', 'sample'], help='beam | greedy | sample')
+parser.add_argument('--top_k', type=int, default=0, help='sample from the top_k words. 0: all words.')
 parser.add_argument('--beam_size', type=int, default=5, help='beam size.')
+parser.add_argument('--len_penalty', type=float, default=0.0, help='length penalty alpha of finished summaries. 0: rank by log probability.')
+parser.add_argument('--cov_penalty', type=float, default=0.0, help='coverage penalty beta of finished summaries.')
+parser.add_argument('--shortlist', type=int, default=0, help='beam search predicts from the shortlist most frequent words, the source words and OOV words. 0: all words.')
 parser.add_argument('--beam_batch_size', type=int, default=1, help='batch size for beam search.')
 parser.add_argument('--copy_words', type=str2bool, default=True, help='Do you want to copy words?')
 parser.add_argument('--model_optimal', type=str2bool, default=True, help='Do you want to use the best model?')
@@ -80,6 +95,18 @@ if args.oov_explicit:
     
 if not args.task == 'train':
     args.dropout = 0.0
+# mixed precision
+amp_device = torch.device(args.device).type
+amp_dtype = torch.bfloat16 if amp_device == 'cpu' else torch.float16
+'''
+Target steps of a loss chunk, 0: no chunks.
+A chunk keeps the fp32 logits, their exponentials and gradients.
+'''
+def logits_chunk_len(batch_size):
+    if args.logits_budget_mb <= 0:
+        return 0
+    
+    return max(1, args.logits_budget_mb*2**20//(12*batch_size*len(vocab2id)))
     
 if not args.task == 'rouge':
     vocab2id, id2vocab = construct_vocab(
@@ -115,13 +142,14 @@ if args.task == 'train' or args.task == 'validate' or args.task == 'beam':
         shared_emb=args.shared_embedding,
         attn_decoder=args.attn_decoder,
         share_emb_weight=args.share_emb_weight
-    ).cuda()
+    ).to(args.device)
     print(model)
 '''
 train
 '''
 if args.task == 'train':
     optimizer = torch.optim.Adam(model.parameters(), lr=args.learning_rate)
+    scaler = torch.amp.GradScaler(amp_device, enabled=args.amp and amp_dtype == torch.float16)
     # read the last check point and continue training
     uf_model = [0, -1]
     if args.continue_training:
@@ -137,7 +165,7 @@ if args.task == 'train':
                 uf_model.append([int(arr[1]), int(arr[2])])
             uf_model = sorted(uf_model)[-1]
             fl_ = os.path.join(out_dir, 'seq2seq_'+str(uf_model[0])+'_'+str(uf_model[1])+'.model')
-            model.load_state_dict(torch.load(fl_))
+            model.load_state_dict(torch.load(fl_, map_location=args.device))
     else:
         lead_dir = args.data_dir+'/seq2seq_results-'
         for k in range(1000000):
@@ -149,78 +177,105 @@ if args.task == 'train':
     losses = []
     start_time = time.time()
     cclb = 0
+    if args.compiled_corpus:
+        train_corpus = load_compiled_corpus(
+            path_=args.data_dir, fkey_='train', file_=args.file_corpus,
+            vocab2id=vocab2id, src_vocab2id=src_vocab2id)
+    else:
+        train_corpus = TextCorpus(path_=args.data_dir, file_=args.file_corpus)
+    if args.batch_tokens > 0:
+        train_sampler = BucketBatchSampler(
+            lengths=train_corpus.lengths(), max_tokens=args.batch_tokens, 
+            max_lens=[args.src_seq_lens, args.trg_seq_lens], 
+            shuffle=True, seed=args.seed)
+    else:
+        train_sampler = BatchSampler(
+            n_doc=len(train_corpus), batch_size=args.batch_size, 
+            shuffle=True, seed=args.seed)
+    if args.oov_explicit:
+        build_args = {'vocab2id': vocab2id}
+        if args.compiled_corpus:
+            build_fn = process_minibatch_compiled_explicit
+        else:
+            build_fn = process_minibatch_explicit
+    else:
+        build_args = {'src_vocab2id': src_vocab2id, 'vocab2id': vocab2id}
+        if args.compiled_corpus:
+            build_fn = process_minibatch_compiled
+        else:
+            build_fn = process_minibatch
     for epoch in range(uf_model[0], args.n_epoch):
-        n_batch = create_batch_file(
-            path_=args.data_dir,
-            fkey_='train',
-            file_=args.file_corpus,
-            batch_size=args.batch_size
-        )
+        batch_docs = train_sampler.batches(epoch)
+        n_batch = len(batch_docs)
         print('The number of batches: {}'.format(n_batch))
-        for batch_id in range(n_batch):
-            if cclb == 0 and batch_id <= uf_model[1]:
-                continue
-            else:
-                cclb += 1
+        # skip the batches trained before the checkpoint.
+        start_batch = uf_model[1]+1 if cclb == 0 else 0
+        train_loader = minibatch_loader(
+            MinibatchDataset(
+                train_corpus, batch_docs[start_batch:], build_fn, 
+                max_lens=[args.src_seq_lens, args.trg_seq_lens], 
+                pad_to_longest=args.batch_tokens > 0, **build_args),
+            num_workers=args.num_workers, prefetch=args.prefetch, 
+            pin_memory=args.pin_memory)
+        for batch_id, batch_ in enumerate(train_loader, start_batch):
+            cclb += 1
             if args.oov_explicit:
                 ext_id2oov, src_var, trg_input_var, \
-                src_var_ex, trg_output_var_ex = process_minibatch_explicit(
-                    batch_id=batch_id, path_=args.data_dir, fkey_='train', 
-                    batch_size=args.batch_size, 
-                    vocab2id=vocab2id, 
-                    max_lens=[args.src_seq_lens, args.trg_seq_lens])
-                src_var = src_var.cuda()
-                trg_input_var = trg_input_var.cuda()
-                src_var_ex = src_var_ex.cuda()
-                trg_output_var_ex = trg_output_var_ex.cuda()
-                
-                weight_mask = torch.ones(len(vocab2id)+len(ext_id2oov)).cuda()
-                weight_mask[vocab2id['<pad>']] = 0
-                loss_criterion = torch.nn.NLLLoss(weight=weight_mask).cuda()
+                src_var_ex, trg_output_var_ex, src_lens_var = batch_
+                src_var = src_var.to(args.device, non_blocking=args.pin_memory)
+                trg_input_var = trg_input_var.to(args.device, non_blocking=args.pin_memory)
+                src_var_ex = src_var_ex.to(args.device, non_blocking=args.pin_memory)
+                trg_output_var_ex = trg_output_var_ex.to(args.device, non_blocking=args.pin_memory)
             else:
-                src_var, trg_input_var, trg_output_var = process_minibatch(
-                    batch_id=batch_id, path_=args.data_dir, fkey_='train', 
-                    batch_size=args.batch_size, 
-                    src_vocab2id=src_vocab2id, vocab2id=vocab2id, 
-                    max_lens=[args.src_seq_lens, args.trg_seq_lens])
+                src_var, trg_input_var, trg_output_var, src_lens_var = batch_
                 
-                weight_mask = torch.ones(len(vocab2id)).cuda()
-                weight_mask[vocab2id['<pad>']] = 0
-                loss_criterion = torch.nn.NLLLoss(weight=weight_mask).cuda()
-                src_var = src_var.cuda()
-                trg_input_var = trg_input_var.cuda()
-                trg_output_var = trg_output_var.cuda()
+                src_var = src_var.to(args.device, non_blocking=args.pin_memory)
+                trg_input_var = trg_input_var.to(args.device, non_blocking=args.pin_memory)
+                trg_output_var = trg_output_var.to(args.device, non_blocking=args.pin_memory)
             
-            logits, attn_, p_gen, loss_cv = model(src_var, trg_input_var)
-            logits = torch.softmax(logits, dim=2)
+            chunk_len = logits_chunk_len(src_var.size(0))
+            optimizer.zero_grad()
+            # logits are the decoder states if the loss is chunked.
+            with torch.autocast(amp_device, dtype=amp_dtype, enabled=args.amp):
+                logits, attn_, p_gen, loss_cv = model(
+                    src_var, trg_input_var, src_lens_var, project=chunk_len == 0)
+            # the loss is computed in fp32
+            loss_cv = loss_cv.float()
             # use the pointer generator loss
-            if args.pointer_net:
-                if args.oov_explicit and len(ext_id2oov) > 0:
-                    logits = model.cal_dist_explicit(src_var_ex, logits, attn_, p_gen, vocab2id, ext_id2oov)
-                    logits = logits + 1e-20
-                else:
-                    logits = model.cal_dist(src_var, logits, attn_, p_gen, src_vocab2id)
-
-            if batch_id%1 == 0:
-                word_prob = logits.topk(1, dim=2)[1].squeeze(2).data.cpu().numpy()
-                
-            logits = torch.log(logits)
             if args.oov_explicit:
-                loss = loss_criterion(
-                    logits.contiguous().view(-1, len(vocab2id)+len(ext_id2oov)),
-                    trg_output_var_ex.view(-1))
+                loss_args = [src_var_ex, logits, attn_, p_gen, trg_output_var_ex, vocab2id['<pad>']]
+            else:
+                loss_args = [src_var, logits, attn_, p_gen, trg_output_var, vocab2id['<pad>']]
+            if chunk_len > 0:
+                loss = model.cal_loss_chunk(*loss_args, chunk_len, scaler.get_scale())
             else:
-                loss = loss_criterion(
-                    logits.contiguous().view(-1, len(vocab2id)),
-                    trg_output_var.view(-1))
+                loss = model.cal_loss(*loss_args)
+
+            if batch_id%1 == 0:
+                # the most probable words of the first document
+                with torch.no_grad():
+                    logits_ = logits[:1]
+                    if chunk_len > 0:
+                        with torch.autocast(amp_device, dtype=amp_dtype, enabled=args.amp):
+                            logits_ = model.output2vocab(logits_)
+                    logits_ = torch.softmax(logits_.float(), dim=2)
+                    if args.pointer_net:
+                        if args.oov_explicit and len(ext_id2oov) > 0:
+                            logits_ = model.cal_dist_explicit(
+                                src_var_ex[:1], logits_, attn_[:, :1], p_gen[:1], vocab2id, ext_id2oov)
+                        else:
+                            logits_ = model.cal_dist(
+                                src_var[:1], logits_, attn_[:, :1], p_gen[:1], src_vocab2id)
+                    word_prob = logits_.topk(1, dim=2)[1].squeeze(2).data.cpu().numpy()
 
             if args.repetition == 'asee_train':
                 loss = loss + loss_cv[0]
             
-            optimizer.zero_grad()
-            loss.backward()
+            scaler.scale(loss).backward()
+            scaler.unscale_(optimizer)
             torch.nn.utils.clip_grad_norm_(model.parameters(), args.grad_clip)
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
         
             end_time = time.time()
             losses.append([
@@ -255,7 +310,7 @@ if args.task == 'train':
         
         loss_np = np.array(losses)
         np.save(out_dir+'/loss', loss_np)
-        fmodel = open(os.path.join(out_dir, 'seq2seq_'+str(epoch)+'_'+str(batch_id)+'.model'), 'wb')
+        fmodel = open(os.path.join(out_dir, 'seq2seq_'+str(epoch)+'_'+str(n_batch-1)+'.model'), 'wb')
         torch.save(model.state_dict(), fmodel)
         fmodel.close()
             
@@ -274,6 +329,21 @@ if args.task == 'validate':
             best_arr.append([arr[0], float(arr[1]), float(arr[2])])
         fp.close()
 
+    if args.compiled_corpus:
+        val_corpus = load_compiled_corpus(
+            path_=args.data_dir, fkey_='validate', file_=args.file_val,
+            vocab2id=vocab2id, src_vocab2id=src_vocab2id)
+    else:
+        val_corpus = TextCorpus(path_=args.data_dir, file_=args.file_val)
+    if args.batch_tokens > 0:
+        val_sampler = BucketBatchSampler(
+            lengths=val_corpus.lengths(), max_tokens=args.batch_tokens, 
+            max_lens=[args.src_seq_lens, args.trg_seq_lens], 
+            shuffle=True, seed=args.seed)
+    else:
+        val_sampler = BatchSampler(
+            n_doc=len(val_corpus), batch_size=args.batch_size, 
+            shuffle=True, seed=args.seed)
     model.eval()
     with torch.no_grad(): 
         while 1:
@@ -295,67 +365,65 @@ if args.task == 'validate':
                 start_time = time.time()
                 if os.path.exists(fl_):
                     time.sleep(3)
-                    model.load_state_dict(torch.load(fl_))
+                    model.load_state_dict(torch.load(fl_, map_location=args.device))
                 else:
                     continue
-                val_batch = create_batch_file(
-                    path_=args.data_dir,
-                    fkey_='validate',
-                    file_=args.file_val,
-                    batch_size=args.batch_size
-                )
+                batch_docs = val_sampler.batches(len(best_arr))
+                val_batch = len(batch_docs)
                 print('The number of batches (test): {}'.format(val_batch))
                 if args.val_num_batch > val_batch:
                     args.val_num_batch = val_batch
                 for batch_id in range(args.val_num_batch):
 
                     if args.oov_explicit:
-                        ext_id2oov, src_var, trg_input_var, \
-                        src_var_ex, trg_output_var_ex = process_minibatch_explicit(
-                            batch_id=batch_id, path_=args.data_dir, fkey_='validate', 
-                            batch_size=args.batch_size, 
-                            vocab2id=vocab2id, 
-                            max_lens=[args.src_seq_lens, args.trg_seq_lens])
-                        src_var = src_var.cuda()
-                        trg_input_var = trg_input_var.cuda()
-                        src_var_ex = src_var_ex.cuda()
-                        trg_output_var_ex = trg_output_var_ex.cuda()
-
-                        weight_mask = torch.ones(len(vocab2id)+len(ext_id2oov)).cuda()
-                        weight_mask[vocab2id['<pad>']] = 0
-                        loss_criterion = torch.nn.NLLLoss(weight=weight_mask).cuda()
+                        if args.compiled_corpus:
+                            ext_id2oov, src_var, trg_input_var, \
+                            src_var_ex, trg_output_var_ex, src_lens_var = process_minibatch_compiled_explicit(
+                                corpus=val_corpus, doc_ids=batch_docs[batch_id], 
+                                vocab2id=vocab2id, 
+                                max_lens=[args.src_seq_lens, args.trg_seq_lens], 
+                                pad_to_longest=args.batch_tokens > 0)
+                        else:
+                            ext_id2oov, src_var, trg_input_var, \
+                            src_var_ex, trg_output_var_ex, src_lens_var = process_minibatch_explicit(
+                                lines=val_corpus.lines(batch_docs[batch_id]), 
+                                vocab2id=vocab2id, 
+                                max_lens=[args.src_seq_lens, args.trg_seq_lens], 
+                                pad_to_longest=args.batch_tokens > 0)
+                        src_var = src_var.to(args.device)
+                        trg_input_var = trg_input_var.to(args.device)
+                        src_var_ex = src_var_ex.to(args.device)
+                        trg_output_var_ex = trg_output_var_ex.to(args.device)
                     else:
-                        src_var, trg_input_var, trg_output_var = process_minibatch(
-                            batch_id=batch_id, path_=args.data_dir, fkey_='validate', 
-                            batch_size=args.batch_size, 
-                            src_vocab2id=src_vocab2id, vocab2id=vocab2id, 
-                            max_lens=[args.src_seq_lens, args.trg_seq_lens])
-                        weight_mask = torch.ones(len(vocab2id)).cuda()
-                        weight_mask[vocab2id['<pad>']] = 0
-                        loss_criterion = torch.nn.NLLLoss(weight=weight_mask).cuda()
-                        src_var = src_var.cuda()
-                        trg_input_var = trg_input_var.cuda()
-                        trg_output_var = trg_output_var.cuda()
-
-                    logits, attn_, p_gen, loss_cv = model(src_var.cuda(), trg_input_var.cuda())
-                    logits = torch.softmax(logits, dim=2)
-                    # use the pointer generator loss
-                    if args.pointer_net:
-                        if args.oov_explicit and len(ext_id2oov) > 0:
-                            logits = model.cal_dist_explicit(src_var_ex, logits, attn_, p_gen, vocab2id, ext_id2oov)
-                            logits = logits + 1e-20
+                        if args.compiled_corpus:
+                            src_var, trg_input_var, trg_output_var, src_lens_var = process_minibatch_compiled(
+                                corpus=val_corpus, doc_ids=batch_docs[batch_id], 
+                                src_vocab2id=src_vocab2id, vocab2id=vocab2id, 
+                                max_lens=[args.src_seq_lens, args.trg_seq_lens], 
+                                pad_to_longest=args.batch_tokens > 0)
                         else:
-                            logits = model.cal_dist(src_var, logits, attn_, p_gen, src_vocab2id)
+                            src_var, trg_input_var, trg_output_var, src_lens_var = process_minibatch(
+                                lines=val_corpus.lines(batch_docs[batch_id]), 
+                                src_vocab2id=src_vocab2id, vocab2id=vocab2id, 
+                                max_lens=[args.src_seq_lens, args.trg_seq_lens], 
+                                pad_to_longest=args.batch_tokens > 0)
+                        src_var = src_var.to(args.device)
+                        trg_input_var = trg_input_var.to(args.device)
+                        trg_output_var = trg_output_var.to(args.device)
 
-                    logits = torch.log(logits)
+                    chunk_len = logits_chunk_len(src_var.size(0))
+                    with torch.autocast(amp_device, dtype=amp_dtype, enabled=args.amp):
+                        logits, attn_, p_gen, loss_cv = model(
+                            src_var, trg_input_var, src_lens_var, project=chunk_len == 0)
+                    # use the pointer generator loss
                     if args.oov_explicit:
-                        loss = loss_criterion(
-                            logits.contiguous().view(-1, len(vocab2id)+len(ext_id2oov)),
-                            trg_output_var_ex.view(-1))
+                        loss_args = [src_var_ex, logits, attn_, p_gen, trg_output_var_ex, vocab2id['<pad>']]
+                    else:
+                        loss_args = [src_var, logits, attn_, p_gen, trg_output_var, vocab2id['<pad>']]
+                    if chunk_len > 0:
+                        loss = model.cal_loss_chunk(*loss_args, chunk_len)
                     else:
-                        loss = loss_criterion(
-                            logits.contiguous().view(-1, len(vocab2id)),
-                            trg_output_var.view(-1))
+                        loss = model.cal_loss(*loss_args)
 
                     losses.append(loss.data.cpu().numpy())
                     show_progress(batch_id+1, args.val_num_batch)
@@ -393,12 +461,11 @@ beam
 if args.task == 'beam':
     args.batch_size = args.beam_batch_size
     
-    test_batch = create_batch_file(
-        path_=args.data_dir,
-        fkey_='test',
-        file_=args.file_test,
-        batch_size=args.batch_size
-    )
+    test_corpus = TextCorpus(path_=args.data_dir, file_=args.file_test)
+    batch_docs = BatchSampler(
+        n_doc=len(test_corpus), batch_size=args.batch_size, 
+        shuffle=False).batches()
+    test_batch = len(batch_docs)
     print('The number of batches (test): {}'.format(test_batch))
     
     model.eval()
@@ -413,43 +480,48 @@ if args.task == 'beam':
         else:
             model_optimal_file = os.path.join(args.data_dir, args.model_dir, args.model_file+'.model')
         print("You choose to use {} for decoding.".format(model_optimal_file))
-        print("Batch Size = {}, Beam Size = {}".format(args.batch_size, args.beam_size))
-        model.load_state_dict(torch.load(model_optimal_file))
+        if args.decode == 'beam':
+            search_ = functools.partial(
+                fast_beam_search, beam_size=args.beam_size, 
+                len_penalty=args.len_penalty, cov_penalty=args.cov_penalty, 
+                shortlist=args.shortlist)
+        else:
+            args.beam_size = 1
+            search_ = functools.partial(
+                fast_greedy_search, sample=args.decode == 'sample', top_k=args.top_k)
+        print("Batch Size = {}, Beam Size = {}, Decode = {}".format(args.batch_size, args.beam_size, args.decode))
+        model.load_state_dict(torch.load(model_optimal_file, map_location=args.device))
 
         start_time = time.time()
         if args.oov_explicit:
             fout = open(os.path.join(args.data_dir, 'summaries.txt'), 'w')
             for batch_id in range(test_batch):
-                ext_id2oov, src_var, src_var_ex, src_arr, src_msk, trg_arr \
+                ext_id2oov, src_var, src_var_ex, src_arr, src_msk, trg_arr, src_lens_var \
                 = process_minibatch_explicit_test(
-                    batch_id=batch_id, path_=args.data_dir, 
-                    batch_size=args.batch_size, vocab2id=vocab2id, 
+                    lines=test_corpus.lines(batch_docs[batch_id]), 
+                    vocab2id=vocab2id, 
                     src_lens=args.src_seq_lens
                 )
-                src_msk = src_msk.cuda()
-                src_var = src_var.cuda()
-                src_var_ex = src_var_ex.cuda()
-                beam_seq, beam_prb, beam_attn_ = fast_beam_search(
-                    model=model,
-                    src_text=src_var,
-                    src_text_ex=src_var_ex,
-                    vocab2id=vocab2id,
-                    ext_id2oov=ext_id2oov,
-                    beam_size=args.beam_size,
-                    max_len=args.trg_seq_lens,
-                    network=args.network_,
-                    pointer_net=args.pointer_net,
-                    oov_explicit=args.oov_explicit,
-                    attn_decoder=args.attn_decoder
-                )
-                src_msk = src_msk.repeat(1, args.beam_size).view(
-                    src_msk.size(0), args.beam_size, args.src_seq_lens).unsqueeze(0)
+                src_var = src_var.to(args.device)
+                src_var_ex = src_var_ex.to(args.device)
+                with torch.autocast(amp_device, dtype=amp_dtype, enabled=args.amp):
+                    beam_seq, beam_prb, beam_copy = search_(
+                        model=model,
+                        src_text=src_var,
+                        src_text_ex=src_var_ex,
+                        vocab2id=vocab2id,
+                        ext_id2oov=ext_id2oov,
+                        max_len=args.trg_seq_lens,
+                        network=args.network_,
+                        pointer_net=args.pointer_net,
+                        oov_explicit=args.oov_explicit,
+                        attn_decoder=args.attn_decoder,
+                        src_lens=src_lens_var,
+                        copy_mask=src_msk
+                    )
                 # copy unknown words
                 if args.copy_words:
-                    beam_attn_ = beam_attn_*src_msk
-                    beam_copy = beam_attn_.topk(1, dim=3)[1].squeeze(-1)
-                    beam_copy = beam_copy[:, :, 0].transpose(0, 1)
-                    wdidx_copy = beam_copy.data.cpu().numpy()
+                    wdidx_copy = beam_copy[:, 0].data.cpu().numpy()
                     for b in range(len(trg_arr)):
                         arr = []
                         gen_text = beam_seq.data.cpu().numpy()[b,0]
@@ -477,34 +549,30 @@ if args.task == 'beam':
         else:
             fout = open(os.path.join(args.data_dir, 'summaries.txt'), 'w')
             for batch_id in range(test_batch):
-                src_var, src_arr, src_msk, trg_arr = process_minibatch_test(
-                    batch_id=batch_id, path_=args.data_dir, 
-                    batch_size=args.batch_size, vocab2id=src_vocab2id, 
+                src_var, src_arr, src_msk, trg_arr, src_lens_var = process_minibatch_test(
+                    lines=test_corpus.lines(batch_docs[batch_id]), 
+                    vocab2id=src_vocab2id, 
                     src_lens=args.src_seq_lens
                 )
-                src_msk = src_msk.cuda()
-                src_var = src_var.cuda()
-                beam_seq, beam_prb, beam_attn_ = fast_beam_search(
-                    model=model,
-                    src_text=src_var,
-                    src_text_ex=src_var, 
-                    vocab2id=src_vocab2id,
-                    ext_id2oov=src_vocab2id,
-                    beam_size=args.beam_size, 
-                    max_len=args.trg_seq_lens,
-                    network=args.network_,
-                    pointer_net=args.pointer_net,
-                    oov_explicit=args.oov_explicit,
-                    attn_decoder=args.attn_decoder
-                )
-                src_msk = src_msk.repeat(1, args.beam_size).view(
-                    src_msk.size(0), args.beam_size, args.src_seq_lens).unsqueeze(0)
+                src_var = src_var.to(args.device)
+                with torch.autocast(amp_device, dtype=amp_dtype, enabled=args.amp):
+                    beam_seq, beam_prb, beam_copy = search_(
+                        model=model,
+                        src_text=src_var,
+                        src_text_ex=src_var, 
+                        vocab2id=src_vocab2id,
+                        ext_id2oov=src_vocab2id,
+                        max_len=args.trg_seq_lens,
+                        network=args.network_,
+                        pointer_net=args.pointer_net,
+                        oov_explicit=args.oov_explicit,
+                        attn_decoder=args.attn_decoder,
+                        src_lens=src_lens_var,
+                        copy_mask=src_msk
+                    )
                 # copy unknown words
                 if args.copy_words:
-                    beam_attn_ = beam_attn_*src_msk
-                    beam_copy = beam_attn_.topk(1, dim=3)[1].squeeze(-1)
-                    beam_copy = beam_copy[:, :, 0].transpose(0, 1)
-                    wdidx_copy = beam_copy.data.cpu().numpy()
+                    wdidx_copy = beam_copy[:, 0].data.cpu().numpy()
                     for b in range(len(trg_arr)):
                         arr = []
                         gen_text = beam_seq.data.cpu().numpy()[b,0]
@@ -3,7 +3,6 @@
 Please contact tshi@vt.edu
 '''
 import torch
-from torch.autograd import Variable
 '''
 Bahdanau, D., Cho, K., & Bengio, Y. (2014). 
 Neural machine translation by jointly learning to align and translate. 
@@ -32,45 +31,62 @@ class AttentionEncoder(torch.nn.Module):
         self.src_hidden_size = src_hidden_size
         self.trg_hidden_size = trg_hidden_size
         self.repetition = repetition
+        # otherwise the keys are the encoder states themselves.
+        self.project_key = self.method in ['luong_concat', 'luong_general']
         
         if self.method == 'luong_concat':
             self.attn_en_in = torch.nn.Linear(
                 self.src_hidden_size,
                 self.trg_hidden_size,
-                bias=True).cuda()
+                bias=True)
             self.attn_de_in = torch.nn.Linear(
                 self.trg_hidden_size,
                 self.trg_hidden_size,
-                bias=False).cuda()
-            self.attn_cv_in = torch.nn.Linear(1, self.trg_hidden_size, bias=False).cuda()
-            self.attn_warp_in = torch.nn.Linear(self.trg_hidden_size, 1, bias=False).cuda()
+                bias=False)
+            self.attn_cv_in = torch.nn.Linear(1, self.trg_hidden_size, bias=False)
+            self.attn_warp_in = torch.nn.Linear(self.trg_hidden_size, 1, bias=False)
         if self.method == 'luong_general':
             self.attn_in = torch.nn.Linear(
                 self.src_hidden_size,
                 self.trg_hidden_size,
-                bias=False).cuda()
+                bias=False)
 
-    def forward(self, dehy, enhy, past_attn):
+    def precompute(self, enhy):
+        '''
+        Encoder side of the attention score.
+        It is the same at every decoding step.
+        '''
+        if self.method == 'luong_concat':
+            return self.attn_en_in(enhy)
+        if self.method == 'luong_general':
+            return self.attn_in(enhy)
+        
+        return enhy
+
+    def forward(self, dehy, enhy, past_attn, src_mask=None, enkey=None):
+        if enkey is None:
+            enkey = self.precompute(enhy)
         # attention score
         if self.method == 'luong_concat':
-            attn_agg = self.attn_en_in(enhy) + self.attn_de_in(dehy.unsqueeze(1))
+            attn_agg = enkey + self.attn_de_in(dehy.unsqueeze(1))
             if self.repetition[:4] == 'asee':
                 attn_agg = attn_agg + self.attn_cv_in(past_attn.unsqueeze(2))
             attn_agg = torch.tanh(attn_agg)
             attn_ee = self.attn_warp_in(attn_agg).squeeze(2)
         else:
-            if self.method == 'luong_general':
-                enhy_new = self.attn_in(enhy)
-                attn_ee = torch.bmm(enhy_new, dehy.unsqueeze(2)).squeeze(2)
-            else:
-                attn_ee = torch.bmm(enhy, dehy.unsqueeze(2)).squeeze(2)
+            attn_ee = torch.bmm(enkey, dehy.unsqueeze(2)).squeeze(2)
         # repetition and attention weights
         if self.repetition == 'temporal':
             attn_ee = torch.exp(attn_ee)
+            if src_mask is not None:
+                attn_ee = attn_ee.masked_fill(~src_mask, 0.0)
+                past_attn = past_attn.masked_fill(~src_mask, 1.0)
             attn = attn_ee/past_attn
             nm = torch.norm(attn, 1, 1).unsqueeze(1)
             attn = attn/nm
         else:
+            if src_mask is not None:
+                attn_ee = attn_ee.masked_fill(~src_mask, float('-inf'))
             attn = torch.softmax(attn_ee, dim=1)
         # context vector
         attn2 = attn.unsqueeze(1)
@@ -94,35 +110,47 @@ class AttentionDecoder(torch.nn.Module):
         super(AttentionDecoder, self).__init__()
         self.method = attn_method.lower()
         self.hidden_size = hidden_size
+        # otherwise the keys are the states themselves.
+        self.project_key = self.method in ['luong_concat', 'luong_general']
         
         if self.method == 'luong_concat':
             self.attn_en_in = torch.nn.Linear(
                 self.hidden_size,
                 self.hidden_size,
-                bias=True).cuda()
+                bias=True)
             self.attn_de_in = torch.nn.Linear(
                 self.hidden_size,
                 self.hidden_size,
-                bias=False).cuda()
-            self.attn_warp_in = torch.nn.Linear(self.hidden_size, 1, bias=False).cuda()
+                bias=False)
+            self.attn_warp_in = torch.nn.Linear(self.hidden_size, 1, bias=False)
         if self.method == 'luong_general':
             self.attn_in = torch.nn.Linear(
                 self.hidden_size, 
                 self.hidden_size,
-                bias=False).cuda()
+                bias=False)
 
-    def forward(self, dehy, past_hy):
+    def precompute(self, past_hy):
+        '''
+        Key of past decoder states. 
+        It is computed once, when a state is added to DecoderMemory.
+        '''
+        if self.method == 'luong_concat':
+            return self.attn_en_in(past_hy)
+        if self.method == 'luong_general':
+            return self.attn_in(past_hy)
+        
+        return past_hy
+
+    def forward(self, dehy, past_hy, past_key=None):
+        if past_key is None:
+            past_key = self.precompute(past_hy)
         # attention score
         if self.method == 'luong_concat':
-            attn_agg = self.attn_en_in(past_hy) + self.attn_de_in(dehy.unsqueeze(1))
+            attn_agg = past_key + self.attn_de_in(dehy.unsqueeze(1))
             attn_agg = torch.tanh(attn_agg)
             attn = self.attn_warp_in(attn_agg).squeeze(2)
         else:
-            if self.method == 'luong_general':
-                past_hy_new = self.attn_in(past_hy)
-                attn = torch.bmm(past_hy_new, dehy.unsqueeze(2)).squeeze(2)
-            else:
-                attn = torch.bmm(past_hy, dehy.unsqueeze(2)).squeeze(2)
+            attn = torch.bmm(past_key, dehy.unsqueeze(2)).squeeze(2)
         attn = torch.softmax(attn, dim=1)
         # context vector
         attn2 = attn.unsqueeze(1)
@@ -130,6 +158,109 @@ class AttentionDecoder(torch.nn.Module):
         
         return c_decoder, attn
 '''
+Past decoder hidden states of the intra-decoder attention, and their keys.
+States are written into a batch*max_len*hidden buffer in place,
+and length counts the states written so far.
+'''
+class DecoderMemory(object):
+    
+    def __init__(self, max_len=0):
+        self.max_len = max_len
+        self.length = 0
+        self.hidden = None
+        self.key = None
+        # buffers the reordered states are written into.
+        self.hidden_spare = None
+        self.key_spare = None
+        
+    def states(self):
+        '''
+        batch*length*hidden
+        '''
+        return self.hidden[:, :self.length]
+    
+    def keys(self):
+        '''
+        batch*length*hidden, see AttentionDecoder.precompute.
+        '''
+        if self.key is None:
+            return None
+        
+        return self.key[:, :self.length]
+    
+    def append(self, dehy, dekey=None):
+        '''
+        dehy: batch*hidden
+        dekey: batch*hidden
+        '''
+        self.hidden = self.write(self.hidden, dehy)
+        if dekey is not None:
+            self.key = self.write(self.key, dekey)
+        self.length += 1
+        
+    def write(self, buffer_, hy):
+        if hy.requires_grad:
+            # autograd keeps the states read by earlier steps,
+            # so they cannot be overwritten in place.
+            if self.length == 0:
+                return hy.unsqueeze(1)
+            return torch.cat((buffer_[:, :self.length], hy.unsqueeze(1)), 1)
+        if buffer_ is None or self.length == buffer_.size(1):
+            output_ = hy.new_zeros(
+                hy.size(0), max(self.max_len, 2*self.length, 1), hy.size(1))
+            if self.length > 0:
+                output_[:, :self.length] = buffer_[:, :self.length]
+            buffer_ = output_
+        buffer_[:, self.length] = hy
+        
+        return buffer_
+        
+    def reorder(self, index):
+        '''
+        index: rows of the surviving hypotheses.
+        '''
+        if self.length == 0:
+            return
+        self.hidden, self.hidden_spare = self.select(self.hidden, self.hidden_spare, index)
+        if self.key is not None:
+            self.key, self.key_spare = self.select(self.key, self.key_spare, index)
+            
+    def select(self, buffer_, spare_, index):
+        '''
+        Gather rows of buffer_ into spare_, and swap the two.
+        Only the filled part (length) of the buffers is copied.
+        A smaller index drops rows, e.g. finished examples in beam search.
+        '''
+        if buffer_.requires_grad:
+            return buffer_.index_select(0, index), None
+        if spare_ is None or spare_.size(1) != buffer_.size(1) or spare_.size(0) != index.size(0):
+            spare_ = buffer_.new_empty(index.size(0), *buffer_.size()[1:])
+        torch.index_select(
+            buffer_[:, :self.length], 0, index, out=spare_[:, :self.length])
+        
+        return spare_, buffer_
+'''
+One step of LSTMCell from its gates, 
+x*weight_ih + bias_ih + h*weight_hh + bias_hh.
+'''
+def lstm_step(gates, c_t):
+    in_gate, forget_gate, cell_gate, out_gate = gates.chunk(4, 1)
+    c_t = torch.sigmoid(forget_gate)*c_t + torch.sigmoid(in_gate)*torch.tanh(cell_gate)
+    h_t = torch.sigmoid(out_gate)*torch.tanh(c_t)
+    
+    return h_t, c_t
+'''
+One step of GRUCell from x*weight_ih + bias_ih and h*weight_hh + bias_hh.
+'''
+def gru_step(gates_x, gates_h, h_t):
+    reset_x, update_x, new_x = gates_x.chunk(3, 1)
+    reset_h, update_h, new_h = gates_h.chunk(3, 1)
+    reset_gate = torch.sigmoid(reset_x + reset_h)
+    update_gate = torch.sigmoid(update_x + update_h)
+    new_gate = torch.tanh(new_x + reset_gate*new_h)
+    
+    return new_gate + update_gate*(h_t - new_gate)
+'''
 LSTM decoder
 '''    
 class LSTMDecoder(torch.nn.Module):
@@ -157,72 +288,77 @@ class LSTMDecoder(torch.nn.Module):
         
         self.lstm_ = torch.nn.LSTMCell(
             self.input_size+self.trg_hidden_size, 
-            self.trg_hidden_size).cuda()
+            self.trg_hidden_size)
         self.encoder_attn_layer = AttentionEncoder(
             src_hidden_size=self.src_hidden_size,
             trg_hidden_size=self.trg_hidden_size,
             attn_method=self.attn_method, 
-            repetition=self.repetition).cuda()
+            repetition=self.repetition)
         # intra-decoder
         if self.attn_decoder:           
             self.decoder_attn_layer = AttentionDecoder(
                 hidden_size=self.trg_hidden_size,
-                attn_method=self.attn_method).cuda()
+                attn_method=self.attn_method)
             self.attn_out = torch.nn.Linear(
                 self.src_hidden_size+self.trg_hidden_size*2,
                 self.trg_hidden_size,
-                bias=True).cuda()
+                bias=True)
         else:
             self.attn_out = torch.nn.Linear(
                 self.src_hidden_size+self.trg_hidden_size,
                 self.trg_hidden_size,
-                bias=True).cuda()
+                bias=True)
         # pointer generator network
         if self.pointer_net:
             if self.attn_decoder:   
                 self.pt_out = torch.nn.Linear(
-                    self.input_size+self.src_hidden_size+self.trg_hidden_size*2, 1).cuda()
+                    self.input_size+self.src_hidden_size+self.trg_hidden_size*2, 1)
             else:
                 self.pt_out = torch.nn.Linear(
-                    self.input_size+self.src_hidden_size+self.trg_hidden_size, 1).cuda()
+                    self.input_size+self.src_hidden_size+self.trg_hidden_size, 1)
         
     def forward(
         self, idx, input_, hidden_, h_attn, 
-        encoder_hy, past_attn, p_gen, past_dehy):
+        encoder_hy, past_attn, p_gen, past_dehy, src_mask=None, encoder_key=None):
         
         if self.batch_first:
             input_ = input_.transpose(0,1)
         batch_size = input_.size(1)
+        if encoder_key is None:
+            encoder_key = self.encoder_attn_layer.precompute(encoder_hy)
         
         output_ = []
         out_attn = []
+        out_pt = []
         
-        loss_cv = Variable(torch.zeros(1)).cuda()
+        loss_cv = h_attn.new_zeros(1)
         batch_size = input_.size(1)
+        # the parts of the gates that depend on the target words 
+        # are computed for all steps at once.
+        x_gates = torch.nn.functional.linear(
+            input_, self.lstm_.weight_ih[:, :self.input_size], 
+            self.lstm_.bias_ih+self.lstm_.bias_hh)
+        attn_weight_ih = self.lstm_.weight_ih[:, self.input_size:]
         for k in range(input_.size(0)):
-            x_input = torch.cat((input_[k], h_attn), 1)
-            hidden_ = self.lstm_(x_input, hidden_)
+            gates = x_gates[k] \
+                + torch.nn.functional.linear(h_attn, attn_weight_ih) \
+                + torch.nn.functional.linear(hidden_[0], self.lstm_.weight_hh)
+            hidden_ = lstm_step(gates, hidden_[1])
             # attention encoder
             c_encoder, attn, attn_ee = self.encoder_attn_layer(
-                hidden_[0], encoder_hy, past_attn)
+                hidden_[0], encoder_hy, past_attn, src_mask, encoder_key)
             # attention decoder
             if self.attn_decoder:
                 if k + idx == 0:
-                    c_decoder = Variable(torch.zeros(
-                        batch_size, self.trg_hidden_size)).cuda()
+                    c_decoder = h_attn.new_zeros(
+                        batch_size, self.trg_hidden_size)
                 else:
                     c_decoder, attn_de = self.decoder_attn_layer(
-                        hidden_[0], past_dehy)
-                past_dehy = past_dehy.transpose(0, 1) # seqL*batch*hidden
-                de_idx = past_dehy.size(0)
-                if k + idx == 0:
-                    past_dehy = hidden_[0].unsqueeze(0) # seqL*batch*hidden
-                    past_dehy = past_dehy.transpose(0, 1) # batch*seqL*hidden
-                else:
-                    past_dehy = past_dehy.contiguous().view(-1, self.trg_hidden_size) # seqL*batch**hidden
-                    past_dehy = torch.cat((past_dehy, hidden_[0]), 0) # (seqL+1)*batch**hidden
-                    past_dehy = past_dehy.view(de_idx+1, batch_size, self.trg_hidden_size) # (seqL+1)*batch*hidden
-                    past_dehy = past_dehy.transpose(0, 1) # batch*(seqL+1)*hidden
+                        hidden_[0], past_dehy.states(), past_dehy.keys())
+                dekey = None
+                if self.decoder_attn_layer.project_key:
+                    dekey = self.decoder_attn_layer.precompute(hidden_[0])
+                past_dehy.append(hidden_[0], dekey)
                 h_attn = self.attn_out(torch.cat((c_encoder, c_decoder, hidden_[0]), 1))
             else:
                 h_attn = self.attn_out(torch.cat((c_encoder, hidden_[0]), 1))
@@ -246,17 +382,16 @@ class LSTMDecoder(torch.nn.Module):
             # pointer
             if self.pointer_net:
                 if self.attn_decoder:
-                    pt_input = torch.cat((input_[k], hidden_[0], c_encoder, c_decoder), 1)
+                    out_pt.append(torch.cat((hidden_[0], c_encoder, c_decoder), 1))
                 else:
-                    pt_input = torch.cat((input_[k], hidden_[0], c_encoder), 1)
-                p_gen[:, k] = torch.sigmoid(self.pt_out(pt_input).squeeze(1))
+                    out_pt.append(torch.cat((hidden_[0], c_encoder), 1))
                     
-        len_seq = input_.size(0)
-        batch_size, hidden_size = output_[0].size()
-        output_ = torch.cat(output_, 0).view(
-            len_seq, batch_size, hidden_size)
-        out_attn = torch.cat(out_attn, 0).view(
-            len_seq, attn.size(0), attn.size(1))
+        output_ = torch.stack(output_, 0)
+        out_attn = torch.stack(out_attn, 0)
+        # pointer of all steps
+        if self.pointer_net:
+            pt_input = torch.cat((input_, torch.stack(out_pt, 0)), 2)
+            p_gen = torch.sigmoid(self.pt_out(pt_input)).squeeze(2).transpose(0, 1)
         
         if self.batch_first:
             output_ = output_.transpose(0,1)
@@ -290,72 +425,76 @@ class GRUDecoder(torch.nn.Module):
         
         self.gru_ = torch.nn.GRUCell(
             self.input_size+self.trg_hidden_size, 
-            self.trg_hidden_size).cuda()
+            self.trg_hidden_size)
         self.encoder_attn_layer = AttentionEncoder(
             src_hidden_size=self.src_hidden_size,
             trg_hidden_size=self.trg_hidden_size,
             attn_method=self.attn_method,
-            repetition=self.repetition).cuda()
+            repetition=self.repetition)
         # intra-decoder
         if self.attn_decoder:
             self.decoder_attn_layer = AttentionDecoder(
                 hidden_size=self.trg_hidden_size,
-                attn_method=self.attn_method).cuda()
+                attn_method=self.attn_method)
             self.attn_out = torch.nn.Linear(
                 self.src_hidden_size + self.trg_hidden_size*2,
                 self.trg_hidden_size,
-                bias=True).cuda()
+                bias=True)
         else:
             self.attn_out = torch.nn.Linear(
                 self.src_hidden_size + self.trg_hidden_size,
                 self.trg_hidden_size,
-                bias=True).cuda()
+                bias=True)
         # pointer generator network
         if self.pointer_net:
             if self.attn_decoder:   
                 self.pt_out = torch.nn.Linear(
-                    self.input_size+self.src_hidden_size + self.trg_hidden_size*2, 1).cuda()
+                    self.input_size+self.src_hidden_size + self.trg_hidden_size*2, 1)
             else:
                 self.pt_out = torch.nn.Linear(
-                    self.input_size+self.src_hidden_size + self.trg_hidden_size, 1).cuda()
+                    self.input_size+self.src_hidden_size + self.trg_hidden_size, 1)
             
     def forward(
         self, idx, input_, hidden_, h_attn, 
-        encoder_hy, past_attn, p_gen, past_dehy):
-            
+        encoder_hy, past_attn, p_gen, past_dehy, src_mask=None, encoder_key=None):
+        
         if self.batch_first:
             input_ = input_.transpose(0,1)
         batch_size = input_.size(1)
+        if encoder_key is None:
+            encoder_key = self.encoder_attn_layer.precompute(encoder_hy)
         
         output_ = []
         out_attn = []
+        out_pt = []
         
-        loss_cv = Variable(torch.zeros(1)).cuda()
+        loss_cv = h_attn.new_zeros(1)
         batch_size = input_.size(1)
+        # the parts of the gates that depend on the target words 
+        # are computed for all steps at once.
+        x_gates = torch.nn.functional.linear(
+            input_, self.gru_.weight_ih[:, :self.input_size], self.gru_.bias_ih)
+        attn_weight_ih = self.gru_.weight_ih[:, self.input_size:]
         for k in range(input_.size(0)):
-            x_input = torch.cat((input_[k], h_attn), 1)
-            hidden_ = self.gru_(x_input, hidden_)
+            hidden_ = gru_step(
+                x_gates[k] + torch.nn.functional.linear(h_attn, attn_weight_ih), 
+                torch.nn.functional.linear(hidden_, self.gru_.weight_hh, self.gru_.bias_hh), 
+                hidden_)
             # attention encoder
             c_encoder, attn, attn_ee = self.encoder_attn_layer(
-                hidden_, encoder_hy, past_attn)
+                hidden_, encoder_hy, past_attn, src_mask, encoder_key)
             # attention decoder
             if self.attn_decoder:
                 if k + idx == 0:
-                    c_decoder = Variable(torch.zeros(
-                        batch_size, self.trg_hidden_size)).cuda()
+                    c_decoder = h_attn.new_zeros(
+                        batch_size, self.trg_hidden_size)
                 else:
                     c_decoder, attn_de = self.decoder_attn_layer(
-                        hidden_, past_dehy)
-                past_dehy = past_dehy.transpose(0, 1) # seqL*batch*hidden
-                de_idx = past_dehy.size(0)
-                if k + idx == 0:
-                    past_dehy = hidden_.unsqueeze(0) # seqL*batch*hidden
-                    past_dehy = past_dehy.transpose(0, 1) # batch*seqL*hidden
-                else:
-                    past_dehy = past_dehy.contiguous().view(-1, self.trg_hidden_size) # seqL*batch**hidden
-                    past_dehy = torch.cat((past_dehy, hidden_), 0) # (seqL+1)*batch**hidden
-                    past_dehy = past_dehy.view(de_idx+1, batch_size, self.trg_hidden_size) # (seqL+1)*batch*hidden
-                    past_dehy = past_dehy.transpose(0, 1) # batch*(seqL+1)*hidden
+                        hidden_, past_dehy.states(), past_dehy.keys())
+                dekey = None
+                if self.decoder_attn_layer.project_key:
+                    dekey = self.decoder_attn_layer.precompute(hidden_)
+                past_dehy.append(hidden_, dekey)
                 h_attn = self.attn_out(torch.cat((c_encoder, c_decoder, hidden_), 1))
             else:
                 h_attn = self.attn_out(torch.cat((c_encoder, hidden_), 1))
@@ -378,23 +517,39 @@ class GRUDecoder(torch.nn.Module):
             out_attn.append(attn)
             if self.pointer_net:
                 if self.attn_decoder:
-                    pt_input = torch.cat((input_[k], hidden_, c_encoder, c_decoder), 1)
+                    out_pt.append(torch.cat((hidden_, c_encoder, c_decoder), 1))
                 else:
-                    pt_input = torch.cat((input_[k], hidden_, c_encoder), 1)
-                p_gen[:, k] = torch.sigmoid(self.pt_out(pt_input).squeeze(1))
+                    out_pt.append(torch.cat((hidden_, c_encoder), 1))
             
-        len_seq = input_.size(0)
-        batch_size, hidden_size = output_[0].size()
-        output_ = torch.cat(output_, 0).view(
-            len_seq, batch_size, hidden_size)
-        out_attn = torch.cat(out_attn, 0).view(
-            len_seq, attn.size(0), attn.size(1))
+        output_ = torch.stack(output_, 0)
+        out_attn = torch.stack(out_attn, 0)
+        # pointer of all steps
+        if self.pointer_net:
+            pt_input = torch.cat((input_, torch.stack(out_pt, 0)), 2)
+            p_gen = torch.sigmoid(self.pt_out(pt_input)).squeeze(2).transpose(0, 1)
         
         if self.batch_first:
             output_ = output_.transpose(0,1)
 
         return output_, hidden_, h_attn, out_attn, past_attn, p_gen, past_dehy, loss_cv
 '''
+Repeat each row of input_ beam_size times.
+batch*... --> (batch*beam)*...
+'''
+def expand_beam(input_, beam_size):
+    size_ = input_.size()
+    output_ = input_.unsqueeze(1).expand(size_[0], beam_size, *size_[1:])
+
+    return output_.contiguous().view(size_[0]*beam_size, *size_[1:])
+'''
+Mask of the real source words.
+src_lens: batch --> batch*src_seq_len
+'''
+def sequence_mask(src_lens, src_seq_len):
+    src_lens = src_lens.clamp(min=1).unsqueeze(1)
+    
+    return torch.arange(src_seq_len, device=src_lens.device).unsqueeze(0) < src_lens
+'''
 sequence to sequence model
 ''' 
 class Seq2Seq(torch.nn.Module):
@@ -449,16 +604,16 @@ class Seq2Seq(torch.nn.Module):
         if self.shared_emb:
             self.embedding = torch.nn.Embedding(
                 self.trg_vocab_size,
-                self.src_emb_dim).cuda()
+                self.src_emb_dim)
             torch.nn.init.uniform_(self.embedding.weight, -1.0, 1.0)
         else:
             self.src_embedding = torch.nn.Embedding(
                 self.src_vocab_size,
-                self.src_emb_dim).cuda()
+                self.src_emb_dim)
             torch.nn.init.uniform_(self.src_embedding.weight, -1.0, 1.0)
             self.trg_embedding = torch.nn.Embedding(
                 self.trg_vocab_size,
-                self.trg_emb_dim).cuda()
+                self.trg_emb_dim)
             torch.nn.init.uniform_(self.trg_embedding.weight, -1.0, 1.0)
         # network structure
         if self.network_ == 'lstm':
@@ -469,7 +624,7 @@ class Seq2Seq(torch.nn.Module):
                 num_layers=self.src_nlayer,
                 batch_first=self.batch_first,
                 dropout=self.dropout,
-                bidirectional=self.src_bidirect).cuda()
+                bidirectional=self.src_bidirect)
             # decoder
             self.decoder = LSTMDecoder(
                 input_size=self.trg_emb_dim,
@@ -480,7 +635,7 @@ class Seq2Seq(torch.nn.Module):
                 batch_first=self.batch_first,
                 pointer_net=self.pointer_net,
                 attn_decoder=self.attn_decoder
-            ).cuda()
+            )
         elif self.network_ == 'gru':
             # encoder
             self.encoder = torch.nn.GRU(
@@ -489,7 +644,7 @@ class Seq2Seq(torch.nn.Module):
                 num_layers=self.src_nlayer,
                 batch_first=self.batch_first,
                 dropout=self.dropout,
-                bidirectional=self.src_bidirect).cuda()
+                bidirectional=self.src_bidirect)
             # decoder
             self.decoder = GRUDecoder(
                 input_size=self.trg_emb_dim,
@@ -500,36 +655,48 @@ class Seq2Seq(torch.nn.Module):
                 batch_first=self.batch_first,
                 pointer_net=self.pointer_net,
                 attn_decoder=self.attn_decoder
-            ).cuda()
+            )
         # encoder to decoder
         self.encoder2decoder = torch.nn.Linear(
             self.src_hidden_dim*self.src_num_directions,
-            self.trg_hidden_dim).cuda()
+            self.trg_hidden_dim)
         if not self.src_hidden_dim*self.src_hidden_dim == self.trg_hidden_dim:
             self.encoder2decoder_c = torch.nn.Linear(
                 self.src_hidden_dim*self.src_num_directions,
-                self.trg_hidden_dim).cuda()
+                self.trg_hidden_dim)
         # decoder to vocab
         if self.share_emb_weight:
             self.decoder2proj = torch.nn.Linear(
                 self.trg_hidden_dim,
                 self.src_emb_dim,
-                bias=False).cuda()
+                bias=False)
             self.proj2vocab = torch.nn.Linear(
                 self.src_emb_dim,
                 self.trg_vocab_size,
-                bias=True).cuda()
+                bias=True)
             self.proj2vocab.weight.data = self.embedding.weight.data
         else:
             self.decoder2vocab = torch.nn.Linear(
                 self.trg_hidden_dim,
                 self.trg_vocab_size,
-                bias=True).cuda()
-        
-    def forward(self, input_src, input_trg):
+                bias=True)
+
+    def _apply(self, fn, recurse=True):
+        # .to(device) copies every parameter separately,
+        # so the shared embedding weight is tied again afterwards.
+        super(Seq2Seq, self)._apply(fn, recurse)
+        if self.share_emb_weight:
+            self.proj2vocab.weight.data = self.embedding.weight.data
+
+        return self
+
+    def forward(self, input_src, input_trg, src_lens=None, project=True):
         # parameters
         src_seq_len = input_src.size(1)
         trg_seq_len = input_trg.size(1)
+        src_mask = None
+        if src_lens is not None:
+            src_mask = sequence_mask(src_lens.to(input_src.device), src_seq_len)
         # embedding
         if self.shared_emb:
             src_emb = self.embedding(input_src)
@@ -542,28 +709,28 @@ class Seq2Seq(torch.nn.Module):
         if self.batch_first:
             batch_size = input_src.size(0)
         # Variables
-        h0_encoder = Variable(torch.zeros(
+        h0_encoder = src_emb.new_zeros(
             self.encoder.num_layers*self.src_num_directions,
-            batch_size, self.src_hidden_dim)).cuda()
+            batch_size, self.src_hidden_dim)
         if self.repetition == 'temporal':
-            past_attn = Variable(torch.ones(
-                batch_size, src_seq_len)).cuda()
+            past_attn = src_emb.new_ones(
+                batch_size, src_seq_len)
         else:
-            past_attn = Variable(torch.zeros(
-                batch_size, src_seq_len)).cuda()
-        h_attn = Variable(torch.zeros(
-            batch_size, self.trg_hidden_dim)).cuda()
-        p_gen = Variable(torch.zeros(
-            batch_size, trg_seq_len)).cuda()
-        past_dehy = Variable(torch.zeros(1, 1)).cuda()
+            past_attn = src_emb.new_zeros(
+                batch_size, src_seq_len)
+        h_attn = src_emb.new_zeros(
+            batch_size, self.trg_hidden_dim)
+        p_gen = src_emb.new_zeros(
+            batch_size, trg_seq_len)
+        past_dehy = DecoderMemory(trg_seq_len)
         # network
         if self.network_ == 'lstm':
-            c0_encoder = Variable(torch.zeros(
+            c0_encoder = src_emb.new_zeros(
                 self.encoder.num_layers*self.src_num_directions,
-                batch_size, self.src_hidden_dim)).cuda()
+                batch_size, self.src_hidden_dim)
             # encoder
-            encoder_hy, (src_h_t, src_c_t) = self.encoder(
-                src_emb, (h0_encoder, c0_encoder))
+            encoder_hy, (src_h_t, src_c_t) = self.forward_rnn_encoder(
+                src_emb, (h0_encoder, c0_encoder), src_lens)
 
             if self.src_bidirect:
                 h_t = torch.cat((src_h_t[-1], src_h_t[-2]), 1)
@@ -583,11 +750,11 @@ class Seq2Seq(torch.nn.Module):
                 0, trg_emb,
                 (decoder_h0, decoder_c0),
                 h_attn, encoder_hy,
-                past_attn, p_gen, past_dehy)
+                past_attn, p_gen, past_dehy, src_mask)
         elif self.network_ == 'gru':
             # encoder
-            encoder_hy, src_h_t = self.encoder(
-                src_emb, h0_encoder)
+            encoder_hy, src_h_t = self.forward_rnn_encoder(
+                src_emb, h0_encoder, src_lens)
 
             if self.src_bidirect:
                 h_t = torch.cat((src_h_t[-1], src_h_t[-2]), 1)
@@ -600,8 +767,18 @@ class Seq2Seq(torch.nn.Module):
             trg_h, _, _, attn_, _, p_gen, _, loss_cv = self.decoder(
                 0, trg_emb,
                 decoder_h0, h_attn,
-                encoder_hy, past_attn, p_gen, past_dehy)
-        # prepare output
+                encoder_hy, past_attn, p_gen, past_dehy, src_mask)
+        # project = False returns the decoder states, see cal_loss_chunk.
+        if not project:
+            return trg_h, attn_, p_gen, loss_cv
+        decoder_output = self.output2vocab(trg_h)
+
+        return decoder_output, attn_, p_gen, loss_cv
+    
+    def output2vocab(self, trg_h):
+        '''
+        Logits of the decoder states (batch*trg_len*hidden).
+        '''
         trg_h_reshape = trg_h.contiguous().view(
             trg_h.size(0)*trg_h.size(1), trg_h.size(2))
         # consume a lot of memory.
@@ -610,12 +787,29 @@ class Seq2Seq(torch.nn.Module):
             decoder_output = self.proj2vocab(decoder_proj)
         else:
             decoder_output = self.decoder2vocab(trg_h_reshape)
-        decoder_output = decoder_output.view(
+        
+        return decoder_output.view(
             trg_h.size(0), trg_h.size(1), decoder_output.size(1))
-
-        return decoder_output, attn_, p_gen, loss_cv
     
-    def forward_encoder(self, input_src):
+    def forward_rnn_encoder(self, src_emb, hidden_encoder, src_lens=None):
+        '''
+        Run the encoder RNN. With src_lens, the padding is packed away,
+        so the final states are taken at the last real word.
+        '''
+        if src_lens is None:
+            return self.encoder(src_emb, hidden_encoder)
+        
+        src_seq_len = src_emb.size(1) if self.batch_first else src_emb.size(0)
+        src_pack = torch.nn.utils.rnn.pack_padded_sequence(
+            src_emb, src_lens.clamp(min=1).cpu(), 
+            batch_first=self.batch_first, enforce_sorted=False)
+        encoder_hy, hidden_encoder = self.encoder(src_pack, hidden_encoder)
+        encoder_hy, _ = torch.nn.utils.rnn.pad_packed_sequence(
+            encoder_hy, batch_first=self.batch_first, total_length=src_seq_len)
+        
+        return encoder_hy, hidden_encoder
+    
+    def forward_encoder(self, input_src, src_lens=None, trg_seq_len=0):
         # parameters
         src_seq_len = input_src.size(1)
         # embedding
@@ -628,27 +822,27 @@ class Seq2Seq(torch.nn.Module):
         if self.batch_first:
             batch_size = input_src.size(0)
         # Variables
-        h0_encoder = Variable(torch.zeros(
+        h0_encoder = src_emb.new_zeros(
             self.encoder.num_layers*self.src_num_directions,
-            batch_size, self.src_hidden_dim)).cuda()
+            batch_size, self.src_hidden_dim)
         if self.repetition == 'temporal':
-            past_attn = Variable(torch.ones(
-                batch_size, src_seq_len)).cuda()
+            past_attn = src_emb.new_ones(
+                batch_size, src_seq_len)
         else:
-            past_attn = Variable(torch.zeros(
-                batch_size, src_seq_len)).cuda()
-        h_attn = Variable(torch.zeros(
-            batch_size, self.trg_hidden_dim)).cuda()
-        past_dehy = Variable(torch.zeros(1, 1)).cuda()
+            past_attn = src_emb.new_zeros(
+                batch_size, src_seq_len)
+        h_attn = src_emb.new_zeros(
+            batch_size, self.trg_hidden_dim)
+        past_dehy = DecoderMemory(trg_seq_len)
         # network
         if self.network_ == 'lstm':
-            c0_encoder = Variable(torch.zeros(
+            c0_encoder = src_emb.new_zeros(
                 self.encoder.num_layers*self.src_num_directions,
-                batch_size, self.src_hidden_dim)).cuda()
+                batch_size, self.src_hidden_dim)
             # encoder
-            encoder_hy, (src_h_t, src_c_t) = self.encoder(
+            encoder_hy, (src_h_t, src_c_t) = self.forward_rnn_encoder(
                 src_emb, 
-                (h0_encoder, c0_encoder))
+                (h0_encoder, c0_encoder), src_lens)
 
             if self.src_bidirect:
                 h_t = torch.cat((src_h_t[-1], src_h_t[-2]), 1)
@@ -668,8 +862,8 @@ class Seq2Seq(torch.nn.Module):
         
         elif self.network_ == 'gru':
             # encoder
-            encoder_hy, src_h_t = self.encoder(
-                src_emb, h0_encoder)
+            encoder_hy, src_h_t = self.forward_rnn_encoder(
+                src_emb, h0_encoder, src_lens)
 
             if self.src_bidirect:
                 h_t = torch.cat((src_h_t[-1], src_h_t[-2]), 1)
@@ -680,7 +874,33 @@ class Seq2Seq(torch.nn.Module):
             decoder_h0 = torch.tanh(decoder_h0)
                 
             return encoder_hy, decoder_h0, h_attn, past_attn, past_dehy
-    
+
+    def forward_encoder_beam(self, input_src, beam_size, src_lens=None, trg_seq_len=0):
+        '''
+        Run the encoder once per document and expand
+        the outputs across beams. Rows are ordered as (batch, beam).
+        encoder_key: encoder side of the attention, see AttentionEncoder.precompute.
+        '''
+        encoder_hy, hidden_decoder, h_attn, past_attn, past_dehy = self.forward_encoder(
+            input_src, src_lens, trg_seq_len)
+        encoder_key = self.decoder.encoder_attn_layer.precompute(encoder_hy)
+
+        encoder_hy = expand_beam(encoder_hy, beam_size)
+        if self.decoder.encoder_attn_layer.project_key:
+            encoder_key = expand_beam(encoder_key, beam_size)
+        else:
+            encoder_key = encoder_hy
+        if self.network_ == 'lstm':
+            hidden_decoder = (
+                expand_beam(hidden_decoder[0], beam_size),
+                expand_beam(hidden_decoder[1], beam_size))
+        else:
+            hidden_decoder = expand_beam(hidden_decoder, beam_size)
+        h_attn = expand_beam(h_attn, beam_size)
+        past_attn = expand_beam(past_attn, beam_size)
+
+        return encoder_hy, hidden_decoder, h_attn, past_attn, past_dehy, encoder_key
+
     def forward_onestep_decoder(
         self,
         idx,
@@ -689,8 +909,15 @@ class Seq2Seq(torch.nn.Module):
         h_attn,
         encoder_hy,
         past_attn,
-        past_dehy
+        past_dehy,
+        src_mask=None,
+        encoder_key=None,
+        vocab_proj=None
     ):
+        '''
+        vocab_proj: output layer restricted to a shortlist, see shortlist_proj.
+        Logits are then computed for the shortlist words only.
+        '''
         if self.shared_emb:
             trg_emb = self.embedding(input_trg)
         else:
@@ -700,20 +927,24 @@ class Seq2Seq(torch.nn.Module):
         if self.batch_first:
             batch_size = input_trg.size(0)
         # pointer weight
-        p_gen = Variable(torch.zeros(batch_size, 1)).cuda()
+        p_gen = trg_emb.new_zeros(batch_size, 1)
         # decoder
         if self.network_ == 'lstm':
             trg_h, hidden_decoder, h_attn, attn_, past_attn, p_gen, past_dehy, loss_cv = self.decoder(
                 idx, trg_emb, hidden_decoder, h_attn,
-                encoder_hy, past_attn, p_gen, past_dehy)
+                encoder_hy, past_attn, p_gen, past_dehy, src_mask, encoder_key)
         if self.network_ == 'gru':
             trg_h, hidden_decoder, h_attn, attn_, past_attn, p_gen, past_dehy, loss_cv = self.decoder(
                 idx, trg_emb, hidden_decoder, h_attn,
-                encoder_hy, past_attn, p_gen, past_dehy)
+                encoder_hy, past_attn, p_gen, past_dehy, src_mask, encoder_key)
         # prepare output
         trg_h_reshape = trg_h.contiguous().view(
             trg_h.size(0) * trg_h.size(1), trg_h.size(2))
-        if self.share_emb_weight:
+        if vocab_proj is not None:
+            if self.share_emb_weight:
+                trg_h_reshape = self.decoder2proj(trg_h_reshape)
+            decoder_output = torch.nn.functional.linear(trg_h_reshape, *vocab_proj)
+        elif self.share_emb_weight:
             decoder_proj = self.decoder2proj(trg_h_reshape)
             decoder_output = self.proj2vocab(decoder_proj)
         else:
@@ -723,38 +954,111 @@ class Seq2Seq(torch.nn.Module):
 
         return decoder_output, hidden_decoder, h_attn, past_attn, p_gen, attn_, past_dehy
 
+    def shortlist_proj(self, vocab_idx):
+        '''
+        Weight and bias of the output layer for the words in vocab_idx.
+        '''
+        if self.share_emb_weight:
+            vocab_layer = self.proj2vocab
+        else:
+            vocab_layer = self.decoder2vocab
+        
+        return vocab_layer.weight.index_select(0, vocab_idx), \
+               vocab_layer.bias.index_select(0, vocab_idx)
+
     def cal_dist(self, input_src, logits_, attn_, p_gen, src_vocab2id):
         # parameters
         src_seq_len = input_src.size(1)
         trg_seq_len = logits_.size(1)
         batch_size = input_src.size(0)
-        vocab_size = len(src_vocab2id)
+        # mix the distributions in fp32 under autocast
+        logits_, attn_, p_gen = logits_.float(), attn_.float(), p_gen.float()
                 
         attn_ = attn_.transpose(0, 1)
-        # calculate index matrix
-        pt_idx = Variable(torch.FloatTensor(torch.zeros(1, 1, 1))).cuda()
-        pt_idx = pt_idx.repeat(batch_size, src_seq_len, vocab_size)
-        pt_idx.scatter_(2, input_src.unsqueeze(2), 1.0)
+        # add attention weights to the source words
+        pt_idx = input_src.unsqueeze(1).expand(batch_size, trg_seq_len, src_seq_len)
         
-        return p_gen.unsqueeze(2)*logits_ + (1.0-p_gen.unsqueeze(2))*torch.bmm(attn_, pt_idx)
+        return (p_gen.unsqueeze(2)*logits_).scatter_add(
+            2, pt_idx, (1.0-p_gen.unsqueeze(2))*attn_)
     
     def cal_dist_explicit(self, input_src, logits_, attn_, p_gen, vocab2id, ext_id2oov):
         # parameters
         src_seq_len = input_src.size(1)
         trg_seq_len = logits_.size(1)
         batch_size = input_src.size(0)
-        vocab_size = len(vocab2id) + len(ext_id2oov)
+        # mix the distributions in fp32 under autocast
+        logits_, attn_, p_gen = logits_.float(), attn_.float(), p_gen.float()
         
         # extend current structure
-        logits_ex = Variable(torch.zeros(1, 1, 1)).cuda()
-        logits_ex = logits_ex.repeat(batch_size, trg_seq_len, len(ext_id2oov))
+        logits_ex = logits_.new_zeros(batch_size, trg_seq_len, len(ext_id2oov))
         if len(ext_id2oov) > 0:
             logits_ = torch.cat((logits_, logits_ex), -1)
         # pointer
         attn_ = attn_.transpose(0, 1)
-        # calculate index matrix
-        pt_idx = Variable(torch.FloatTensor(torch.zeros(1, 1, 1))).cuda()
-        pt_idx = pt_idx.repeat(batch_size, src_seq_len, vocab_size)
-        pt_idx.scatter_(2, input_src.unsqueeze(2), 1.0)
+        # add attention weights to the source words
+        pt_idx = input_src.unsqueeze(1).expand(batch_size, trg_seq_len, src_seq_len)
+        
+        return (p_gen.unsqueeze(2)*logits_).scatter_add(
+            2, pt_idx, (1.0-p_gen.unsqueeze(2))*attn_)
+    
+    def cal_loss(self, input_src, logits_, attn_, p_gen, target, pad_id, n_word=None):
+        '''
+        NLL loss of the target words, averaged over the non-<pad> words.
+        The same as torch.log of cal_dist / cal_dist_explicit (+1e-20) 
+        with NLLLoss, but only the probabilities of the target words are 
+        computed. Target ids >= vocabulary size are OOV words.
+        n_word: divide the summed loss by n_word instead.
+        '''
+        logits_ = logits_.float()
+        vocab_size = logits_.size(2)
+        # log probability of the target words from the generator
+        trg_logits = logits_.gather(2, target.clamp(max=vocab_size-1).unsqueeze(2)).squeeze(2)
+        log_prob = trg_logits - torch.logsumexp(logits_, dim=2)
+        if self.pointer_net:
+            attn_, p_gen = attn_.float().transpose(0, 1), p_gen.float()
+            prob = log_prob.exp().masked_fill(target >= vocab_size, 0.0)
+            # attention on the source positions of the target words
+            prob_copy = attn_.masked_fill(
+                input_src.unsqueeze(1) != target.unsqueeze(2), 0.0).sum(dim=2)
+            log_prob = torch.log(p_gen*prob + (1.0-p_gen)*prob_copy + 1e-20)
+        mask = (target != pad_id).float()
+        if n_word is None:
+            n_word = mask.sum()
+        
+        return -(log_prob*mask).sum()/n_word
+    
+    def cal_loss_chunk(self, input_src, trg_h, attn_, p_gen, target, pad_id, chunk_len, loss_scale=1.0):
+        '''
+        cal_loss of the decoder states trg_h (forward with project=False), 
+        over chunks of chunk_len target steps. Only the logits of one chunk 
+        are kept in memory.
+        With gradients, every chunk is back-propagated right away to the 
+        output layers and to trg_h, attn_ and p_gen, and the returned loss 
+        back-propagates the accumulated gradients to the rest of the model.
+        loss_scale is the scale of the loss in backward (GradScaler).
+        '''
+        n_word = (target != pad_id).float().sum()
+        outputs_ = [trg_h, attn_, p_gen]
+        backward_ = torch.is_grad_enabled() and trg_h.requires_grad
+        if backward_:
+            outputs_ = [itm.detach().requires_grad_(itm.requires_grad) for itm in outputs_]
+        loss = 0.0
+        for k in range(0, target.size(1), chunk_len):
+            # the projection runs in the precision of the decoder (autocast).
+            with torch.autocast(trg_h.device.type, dtype=trg_h.dtype, enabled=trg_h.dtype != torch.float32):
+                logits_ = self.output2vocab(outputs_[0][:, k:k+chunk_len])
+            loss_ = self.cal_loss(
+                input_src, logits_, outputs_[1][k:k+chunk_len], outputs_[2][:, k:k+chunk_len], 
+                target[:, k:k+chunk_len], pad_id, n_word)
+            if backward_:
+                (loss_*loss_scale).backward()
+            loss = loss + loss_.detach()
+        if not backward_:
+            return loss
+        # its gradients are the gradients of the chunks.
+        loss_grad = sum([
+            (itm.float()*itm_.grad.float()).sum() 
+            for itm, itm_ in zip([trg_h, attn_, p_gen], outputs_) 
+            if itm_.grad is not None])/loss_scale
         
-        return p_gen.unsqueeze(2)*logits_ + (1.0-p_gen.unsqueeze(2))*torch.bmm(attn_, pt_idx)
+        return loss + loss_grad - loss_grad.detach()
@@ -0,0 +1,120 @@
+'''
+@author Tian Shi
+Please contact tshi@vt.edu
+
+Allocations and time per step of fast_beam_search.
+A randomly initialized model is used, so no data is needed.
+'''
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from model import *
+from utils import *
+from beam_search import *
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', help='cuda | cpu')
+parser.add_argument('--batch_size', type=int, default=16, help='batch size.')
+parser.add_argument('--beam_size', type=int, default=5, help='beam size.')
+parser.add_argument('--src_seq_lens', type=int, default=400, help='length of source documents.')
+parser.add_argument('--trg_seq_lens', type=int, default=50, help='decoding steps.')
+parser.add_argument('--vocab_size', type=int, default=50000, help='number of words in the vocabulary.')
+parser.add_argument('--emb_dim', type=int, default=128, help='embedding dimension')
+parser.add_argument('--src_hidden_dim', type=int, default=256, help='encoder hidden dimension')
+parser.add_argument('--trg_hidden_dim', type=int, default=256, help='decoder hidden dimension')
+parser.add_argument('--attn_method', default='luong_concat', help='luong_dot | luong_concat | luong_general')
+parser.add_argument('--repetition', default='vanilla', help='vanilla | temporal | asee')
+parser.add_argument('--network_', default='lstm', help='gru | lstm')
+parser.add_argument('--pointer_net', type=str2bool, default=True, help='Use pointer network?')
+parser.add_argument('--attn_decoder', type=str2bool, default=True, help='attention decoder?')
+parser.add_argument('--shortlist', type=int, default=0, help='vocabulary shortlist of beam search. 0: all words.')
+args = parser.parse_args()
+
+vocab2id = {'<s>': 2, '</s>': 3, '<pad>': 1, '<unk>': 0, '<stop>': 4}
+for k in range(len(vocab2id), args.vocab_size):
+    vocab2id['w'+str(k)] = k
+
+model = Seq2Seq(
+    src_emb_dim=args.emb_dim,
+    trg_emb_dim=args.emb_dim,
+    src_hidden_dim=args.src_hidden_dim,
+    trg_hidden_dim=args.trg_hidden_dim,
+    src_vocab_size=args.vocab_size,
+    trg_vocab_size=args.vocab_size,
+    attn_method=args.attn_method,
+    repetition=args.repetition,
+    network_=args.network_,
+    pointer_net=args.pointer_net,
+    attn_decoder=args.attn_decoder
+).to(args.device)
+model.eval()
+# never emit <stop>, so that every run decodes all steps.
+with torch.no_grad():
+    if model.share_emb_weight:
+        model.proj2vocab.bias[vocab2id['<stop>']] = -1e4
+    else:
+        model.decoder2vocab.bias[vocab2id['<stop>']] = -1e4
+
+src_var = torch.randint(
+    5, args.vocab_size, (args.batch_size, args.src_seq_lens), device=args.device)
+'''
+Run beam search for max_len steps.
+'''
+def run_beam(max_len):
+    with torch.no_grad():
+        fast_beam_search(
+            model=model,
+            src_text=src_var,
+            src_text_ex=src_var,
+            vocab2id=vocab2id,
+            ext_id2oov={},
+            beam_size=args.beam_size,
+            max_len=max_len,
+            network=args.network_,
+            pointer_net=args.pointer_net,
+            oov_explicit=False,
+            attn_decoder=args.attn_decoder,
+            shortlist=args.shortlist
+        )
+    if args.device != 'cpu':
+        torch.cuda.synchronize()
+'''
+Number of allocator calls of a run.
+CUDA: the caching allocator statistics. 
+CPU: the operators that allocate memory, from the profiler.
+'''
+def count_alloc(max_len):
+    if args.device != 'cpu':
+        n_alloc = torch.cuda.memory_stats()['allocation.all.allocated']
+        run_beam(max_len)
+        return torch.cuda.memory_stats()['allocation.all.allocated'] - n_alloc
+    
+    with torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        run_beam(max_len)
+    
+    return len([
+        evt for evt in prof.events() 
+        if evt.self_cpu_memory_usage > 0])
+
+# warm up
+run_beam(args.trg_seq_lens)
+# the difference between two lengths leaves out the encoder and setup.
+n_short = count_alloc(args.trg_seq_lens)
+n_long = count_alloc(args.trg_seq_lens*2)
+start_time = time.time()
+run_beam(args.trg_seq_lens*2)
+time_long = time.time() - start_time
+start_time = time.time()
+run_beam(args.trg_seq_lens)
+time_short = time.time() - start_time
+
+print('device={}, batch={}, beam={}, steps={}'.format(
+    args.device, args.batch_size, args.beam_size, args.trg_seq_lens))
+print('allocations per step: {:.1f}'.format(float(n_long-n_short)/args.trg_seq_lens))
+print('time per step: {:.2f}ms'.format(1000.0*(time_long-time_short)/args.trg_seq_lens))